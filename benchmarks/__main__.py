@@ -0,0 +1,110 @@
+"""
+Offline benchmark suite
+
+Run from the repository root with: python -m benchmarks [--filter NAME] [--save FILE] [--compare FILE]
+"""
+import argparse
+import gc
+import platform
+import sys
+import time
+import tracemalloc
+
+import orjson
+
+from . import bench_embeds, bench_queue, bench_tracker
+
+BENCHMARKS = {
+    **bench_queue.BENCHMARKS,
+    **bench_tracker.BENCHMARKS,
+    **bench_embeds.BENCHMARKS,
+}
+
+
+def measure(setup, repeat: int) -> dict:
+    """
+    Run a benchmark
+    :param setup: a function returning the number of operations and the function to time
+    :param repeat: how many times the function is timed, the best run is kept
+    :return: the ops/sec, the peak traced memory and the blocks still allocated after the run, per operation
+    """
+    ops, run = setup()
+    run()  # warm up
+
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    run()
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    retained = sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0)
+
+    return {
+        "ops_per_sec": ops / best,
+        "peak_bytes_per_op": peak / ops,
+        "retained_blocks_per_op": retained / ops,
+    }
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--filter", "-k", default="", help="run only the benchmarks containing this string")
+    parser.add_argument("--repeat", "-r", type=int, default=5, help="timed runs for each benchmark")
+    parser.add_argument("--save", metavar="FILE", help="store the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results with a stored baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="slowdown ratio reported as a regression (default 0.25)")
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, "rb") as f:
+            baseline = orjson.loads(f.read())["results"]
+
+    results = {}
+    regressions = []
+
+    print(f"{'benchmark':<28} {'ops/sec':>14} {'peak B/op':>10} {'kept/op':>8} {'vs baseline':>12}")
+    for name, setup in BENCHMARKS.items():
+        if args.filter not in name:
+            continue
+
+        result = measure(setup, args.repeat)
+        results[name] = result
+
+        change = ""
+        if name in baseline:
+            ratio = result["ops_per_sec"] / baseline[name]["ops_per_sec"]
+            change = f"{ratio - 1:+.1%}"
+            if ratio < 1 - args.tolerance:
+                regressions.append(name)
+                change += " !"
+
+        print(f"{name:<28} {result['ops_per_sec']:>14,.0f} {result['peak_bytes_per_op']:>10,.0f} "
+              f"{result['retained_blocks_per_op']:>8.2f} {change:>12}")
+
+    if args.save:
+        with open(args.save, "wb") as f:
+            f.write(orjson.dumps({
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "results": results,
+            }, option=orjson.OPT_INDENT_2))
+
+    if regressions:
+        print(f"\nRegressions over {args.tolerance:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
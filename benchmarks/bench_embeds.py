@@ -0,0 +1,44 @@
+"""Benchmarks for the track and playlist embeds"""
+from dsmusic.music import embeds
+
+from .fakes import fake_playlist, fake_tracks
+
+
+def bench_track_embed_cold():
+    tracks = fake_tracks(5_000)
+
+    def run():
+        embeds._cache.clear()
+        embeds.parse_seconds.cache_clear()
+        for track in tracks:
+            embeds.track_embed(track)
+
+    return len(tracks), run
+
+
+def bench_track_embed_warm():
+    # the same 200 popular tracks shown over and over
+    tracks = fake_tracks(200) * 25
+
+    def run():
+        for track in tracks:
+            embeds.track_embed(track).add_field(name="Requested by", value="someone")
+
+    return len(tracks), run
+
+
+def bench_playlist_embed():
+    playlists = [fake_playlist(5, seed=i, name=f"Playlist {i}") for i in range(100)] * 20
+
+    def run():
+        for playlist in playlists:
+            embeds.playlist_embed(playlist).add_field(name="Number of videos", value=5)
+
+    return len(playlists), run
+
+
+BENCHMARKS = {
+    "embeds.track_cold": bench_track_embed_cold,
+    "embeds.track_warm": bench_track_embed_warm,
+    "embeds.playlist": bench_playlist_embed,
+}
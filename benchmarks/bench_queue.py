@@ -0,0 +1,108 @@
+"""Benchmarks for the per-guild queue engine"""
+from dsmusic.music.embeds import queue_embed
+from dsmusic.music.limits import QueueLimits
+from dsmusic.music.queue import Queue
+
+from .fakes import fake_playlist, fake_tracks
+
+UNLIMITED = QueueLimits(max_track_length=10 ** 12, max_total_length=10 ** 15, max_tracks=10 ** 9)
+
+
+def bench_add():
+    tracks = fake_tracks(20_000)
+
+    def run():
+        queue = Queue(limits=UNLIMITED)
+        for track in tracks:
+            queue._add_to_queue(track, requester=1)
+
+    return len(tracks), run
+
+
+def _next(n: int, shuffle: bool = False, loop: bool = False):
+    """Fill a queue in one batch and drain it with next()"""
+    tracks = fake_tracks(n)
+
+    def run():
+        queue = Queue(limits=UNLIMITED)
+        queue._add_many(tracks, requester=1)
+        queue.toggle_shuffle(shuffle)
+        queue.toggle_loop(loop)
+        for _ in range(n):
+            queue.next()
+
+    return n, run
+
+
+def bench_next():
+    return _next(20_000)
+
+
+def bench_next_shuffle():
+    return _next(20_000, shuffle=True)
+
+
+def bench_next_loop():
+    return _next(20_000, loop=True)
+
+
+def bench_next_shuffle_loop():
+    return _next(20_000, shuffle=True, loop=True)
+
+
+def bench_playlist_ingest():
+    playlists = [fake_playlist(500, seed=i, name=f"Playlist {i}") for i in range(20)]
+    limits = QueueLimits(max_track_length=3_600_000, max_total_length=10 ** 12, max_tracks=10 ** 9)
+
+    def run():
+        for playlist in playlists:
+            Queue(limits=limits).add(playlist, requester=1)
+
+    return sum(len(p.tracks) for p in playlists), run
+
+
+def _filled(n: int) -> Queue:
+    queue = Queue(limits=UNLIMITED)
+    queue._add_many(fake_tracks(n), requester=1)
+    return queue
+
+
+def bench_remove_move():
+    """Move entries all over a large queue and back, remove some and add them again at the end"""
+    queue = _filled(20_000)
+    positions = [(i * 7919) % 20_000 for i in range(5_000)]
+
+    def run():
+        for position in positions:
+            destination = (position * 31) % 20_000
+            queue.move(position, destination)
+            queue.move(destination, position)
+
+        removed = [queue.remove(position % len(queue)) for position in positions[:1_000]]
+        queue._add_many([entry.to_track() for entry in removed], requester=1)
+
+    return len(positions) * 2 + len(positions[:1_000]), run
+
+
+def bench_queue_page():
+    """Render pages of a large queue"""
+    queue = _filled(20_000)
+    pages = [(i * 613) % 2_000 for i in range(1_000)]
+
+    def run():
+        for page in pages:
+            queue_embed(queue, page)
+
+    return len(pages), run
+
+
+BENCHMARKS = {
+    "queue.add": bench_add,
+    "queue.next": bench_next,
+    "queue.next_shuffle": bench_next_shuffle,
+    "queue.next_loop": bench_next_loop,
+    "queue.next_shuffle_loop": bench_next_shuffle_loop,
+    "queue.playlist_ingest": bench_playlist_ingest,
+    "queue.remove_move": bench_remove_move,
+    "queue.page": bench_queue_page,
+}
@@ -0,0 +1,75 @@
+"""
+Presence flood microbenchmark for the Tracker cog
+
+Run from the repository root with: python -m benchmarks.bench_tracker
+"""
+import asyncio
+import time
+
+import discord
+
+from dsmusic.tracker.cog import Tracker
+
+from .fakes import presence_flood
+
+GUILDS = 100
+MEMBERS_PER_GUILD = 1000
+TRACKED = 20
+EVENTS = 200_000
+
+
+async def legacy_on_member_update(cog: Tracker, before, after):
+    """The presence handler before the int-keyed index was added"""
+    if before.status != after.status and after.status == discord.Status.online:
+        if str(after.guild.id) in cog.tracking:
+            if str(after.id) in cog.tracking[str(after.guild.id)]:
+                channel = cog.bot.get_channel(int(cog.tracking[str(after.guild.id)][str(after.id)]))
+                if channel.guild == after.guild:
+                    await channel.send(f"{after.mention} is now {after.status}")
+
+
+def build(events: int = EVENTS, seed: int = 0):
+    bot, tracking, pairs = presence_flood(GUILDS, MEMBERS_PER_GUILD, TRACKED, events, seed)
+
+    cog = Tracker(bot, data_file="")
+    cog.tracking = tracking
+    cog._rebuild_index()
+
+    return cog, pairs
+
+
+async def run(handler, cog, events) -> float:
+    start = time.perf_counter()
+    for before, after in events:
+        await handler(cog, before, after)
+    return len(events) / (time.perf_counter() - start)
+
+
+def bench_presence_flood():
+    cog, pairs = build(events=50_000)
+    loop = asyncio.new_event_loop()
+
+    async def flood():
+        handler = cog.on_member_update
+        for before, after in pairs:
+            await handler(before, after)
+
+    return len(pairs), lambda: loop.run_until_complete(flood())
+
+
+BENCHMARKS = {
+    "tracker.presence_flood": bench_presence_flood,
+}
+
+
+def main():
+    cog, events = build()
+    legacy = asyncio.run(run(legacy_on_member_update, cog, events))
+    indexed = asyncio.run(run(Tracker.on_member_update, cog, events))
+
+    print(f"legacy:  {legacy:>12,.0f} events/s")
+    print(f"indexed: {indexed:>12,.0f} events/s ({indexed / legacy:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
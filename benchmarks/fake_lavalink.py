@@ -0,0 +1,461 @@
+"""
+Lavalink v4 stand-in serving synthetic tracks, for load tests on a machine without network
+
+Run from the repository root with: python -m benchmarks.fake_lavalink --port 2333
+"""
+import argparse
+import asyncio
+import base64
+import logging
+import random
+import time
+import uuid
+import zlib
+
+import orjson
+from aiohttp import web, WSMsgType
+
+__all__ = [
+    "FakeLavalink"
+]
+
+
+logger = logging.getLogger('dsbot.benchmarks.fake_lavalink')
+
+SEARCH_PREFIXES = ("ytsearch:", "ytmsearch:", "scsearch:", "spsearch:")
+
+
+def encode_track(info: dict) -> str:
+    """Encode the track info in the identifier given back to the client, so a played track can be rebuilt"""
+    return base64.urlsafe_b64encode(orjson.dumps(info)).decode()
+
+
+def decode_track(encoded: str) -> dict:
+    return orjson.loads(base64.urlsafe_b64decode(encoded))
+
+
+def track_payload(info: dict) -> dict:
+    return {"encoded": encode_track(info), "info": info, "pluginInfo": {}, "userData": {}}
+
+
+class _Player:
+    __slots__ = ("guild_id", "track", "position", "started", "paused", "voice", "task")
+
+    def __init__(self, guild_id: str):
+        self.guild_id = guild_id
+        self.track: dict | None = None
+        self.position = 0
+        self.started = 0.0
+        self.paused = False
+        self.voice: dict | None = None
+        self.task: asyncio.Task | None = None
+
+    def current_position(self) -> int:
+        if self.track is None:
+            return 0
+        if self.paused:
+            return self.position
+        return self.position + int((time.monotonic() - self.started) * 1000)
+
+
+class _Session:
+    __slots__ = ("id", "ws", "transport", "players", "resuming", "timeout", "expiry", "buffered")
+
+    def __init__(self, ws: web.WebSocketResponse, transport: asyncio.Transport | None):
+        self.id = uuid.uuid4().hex[:16]
+        self.ws = ws
+        self.transport = transport
+        self.players: dict[str, _Player] = {}
+        self.resuming = False
+        self.timeout = 60
+        self.expiry: asyncio.TimerHandle | None = None
+        # events sent while the websocket is closed, replayed on resume
+        self.buffered: list[dict] = []
+
+    def abort(self):
+        # without a closing handshake, like a lost connection
+        if self.transport is not None:
+            self.transport.abort()
+
+    def close(self):
+        if self.expiry is not None:
+            self.expiry.cancel()
+        for player in self.players.values():
+            if player.task is not None:
+                player.task.cancel()
+
+
+class FakeLavalink:
+    """
+    In-process Lavalink v4 node: REST and websocket APIs, with synthetic tracks
+
+    Searches return `search_results` tracks, URLs containing "list=" or "playlist" a playlist of `playlist_size`
+    tracks, other URLs a single track, and queries containing "nomatch" no result. Track loading takes a random
+    time in `latency` and fails with probability `failure_rate`. Tracks play `speed` times faster than real time,
+    then a TrackEndEvent is sent; with probability `stuck_rate` a TrackStuckEvent is sent halfway instead.
+
+    Sessions configured for resuming keep playing after their websocket is closed, until their timeout expires.
+    `disconnect()` simulates a network failure and `restart()` a restart of the node.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, password: str = "youshallnotpass",
+                 latency: tuple[float, float] = (0.02, 0.2), failure_rate: float = 0.0, stuck_rate: float = 0.0,
+                 speed: float = 1.0, playlist_size: int = 20, search_results: int = 5, stats_interval: float = 60,
+                 seed: int | None = None):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.stuck_rate = stuck_rate
+        self.speed = speed
+        self.playlist_size = playlist_size
+        self.search_results = search_results
+        self.stats_interval = stats_interval
+
+        self.requests: dict[str, int] = {}
+        self._random = random.Random(seed)
+        self._sessions: dict[str, _Session] = {}
+        self._started = time.monotonic()
+        self._runner: web.AppRunner | None = None
+
+    # Lifecycle
+
+    async def start(self):
+        app = web.Application(middlewares=[self._auth])
+        app.router.add_get("/version", self._version)
+        app.router.add_get("/v4/websocket", self._websocket)
+        app.router.add_get("/v4/loadtracks", self._load_tracks)
+        app.router.add_get("/v4/decodetrack", self._decode_track)
+        app.router.add_patch("/v4/sessions/{session}", self._update_session)
+        app.router.add_get("/v4/sessions/{session}/players", self._get_players)
+        app.router.add_get("/v4/sessions/{session}/players/{guild}", self._get_player)
+        app.router.add_patch("/v4/sessions/{session}/players/{guild}", self._update_player)
+        app.router.add_delete("/v4/sessions/{session}/players/{guild}", self._destroy_player)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+
+        # with port 0 the system picks a free one
+        self.port = site._server.sockets[0].getsockname()[1]
+        logger.info(f"Fake lavalink listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        await self.restart()
+
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def disconnect(self):
+        """Cut the websocket connections, the sessions configured for resuming keep playing"""
+        for session in list(self._sessions.values()):
+            session.abort()
+
+    async def restart(self):
+        """Cut the websocket connections and drop every session, as a crash would do"""
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        for session in sessions:
+            session.close()
+            session.abort()
+
+    # Synthetic tracks
+
+    def _track(self, key: str, index: int = 0) -> dict:
+        seed = zlib.crc32(f"{key}#{index}".encode())
+        identifier = f"fake{seed:010d}"
+        return {
+            "identifier": identifier,
+            "isSeekable": True,
+            "author": f"Author {seed % 97}",
+            "length": 30_000 + seed % 570_000,
+            "isStream": False,
+            "position": 0,
+            "title": f"Track {key[:40]} #{index}",
+            "uri": f"https://example.com/watch?v={identifier}",
+            "artworkUrl": None,
+            "isrc": None,
+            "sourceName": "youtube",
+        }
+
+    def _resolve(self, identifier: str) -> dict:
+        if "nomatch" in identifier:
+            return {"loadType": "empty", "data": {}}
+
+        for prefix in SEARCH_PREFIXES:
+            if identifier.startswith(prefix):
+                query = identifier[len(prefix):]
+                return {"loadType": "search",
+                        "data": [track_payload(self._track(query, i)) for i in range(self.search_results)]}
+
+        if "list=" in identifier or "playlist" in identifier:
+            return {"loadType": "playlist", "data": {
+                "info": {"name": f"Playlist {zlib.crc32(identifier.encode())}", "selectedTrack": -1},
+                "pluginInfo": {},
+                "tracks": [track_payload(self._track(identifier, i)) for i in range(self.playlist_size)],
+            }}
+
+        return {"loadType": "track", "data": track_payload(self._track(identifier))}
+
+    # Websocket
+
+    async def _send(self, session: _Session, data: dict):
+        if not session.ws.closed:
+            await session.ws.send_str(orjson.dumps(data).decode())
+        elif session.resuming and data["op"] == "event":
+            session.buffered.append(data)
+
+    def _stats(self, session: _Session) -> dict:
+        players = list(session.players.values())
+        playing = sum(1 for p in players if p.track is not None and not p.paused)
+        return {
+            "op": "stats",
+            "players": len(players),
+            "playingPlayers": playing,
+            "uptime": int((time.monotonic() - self._started) * 1000),
+            "memory": {"free": 1 << 28, "used": 1 << 27, "allocated": 1 << 29, "reservable": 1 << 30},
+            "cpu": {"cores": 4, "systemLoad": 0.1, "lavalinkLoad": 0.01 * playing},
+            "frameStats": {"sent": 3000 * playing, "nulled": 0, "deficit": 0},
+        }
+
+    async def _websocket(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+
+        session = self._sessions.get(request.headers.get("Session-Id", ""))
+        resumed = session is not None and session.ws.closed
+        if resumed:
+            session.ws, session.transport = ws, request.transport
+            if session.expiry is not None:
+                session.expiry.cancel()
+                session.expiry = None
+        else:
+            session = _Session(ws, request.transport)
+            self._sessions[session.id] = session
+        await self._send(session, {"op": "ready", "resumed": resumed, "sessionId": session.id})
+        buffered, session.buffered = session.buffered, []
+        for data in buffered:
+            await self._send(session, data)
+
+        async def send_stats():
+            while True:
+                await self._send(session, self._stats(session))
+                await asyncio.sleep(self.stats_interval)
+
+        stats = asyncio.create_task(send_stats())
+        try:
+            async for msg in ws:
+                if msg.type == WSMsgType.ERROR:
+                    break
+        finally:
+            stats.cancel()
+            if session.ws is ws and self._sessions.get(session.id) is session:
+                if session.resuming:
+                    session.expiry = asyncio.get_running_loop().call_later(session.timeout, self._expire, session)
+                else:
+                    self._expire(session)
+
+        return ws
+
+    def _expire(self, session: _Session):
+        session.close()
+        if self._sessions.get(session.id) is session:
+            del self._sessions[session.id]
+
+    async def _player_update(self, session: _Session, player: _Player):
+        await self._send(session, {
+            "op": "playerUpdate",
+            "guildId": player.guild_id,
+            "state": {"time": int(time.time() * 1000), "position": player.current_position(),
+                      "connected": player.voice is not None, "ping": 1},
+        })
+
+    async def _event(self, session: _Session, player: _Player, kind: str, track: dict, **extra):
+        await self._send(session, {"op": "event", "type": kind, "guildId": player.guild_id,
+                                   "track": track_payload(track), **extra})
+
+    # Playback
+
+    async def _playback(self, session: _Session, player: _Player):
+        track = player.track
+        remaining = (track["length"] - player.position) / 1000 / self.speed
+
+        try:
+            if self._random.random() < self.stuck_rate:
+                await asyncio.sleep(remaining / 2)
+                player.track, player.task = None, None
+                await self._event(session, player, "TrackStuckEvent", track, thresholdMs=10_000)
+            else:
+                await asyncio.sleep(remaining)
+                player.track, player.task = None, None
+                await self._event(session, player, "TrackEndEvent", track, reason="finished")
+        except asyncio.CancelledError:
+            pass
+
+    def _schedule(self, session: _Session, player: _Player):
+        if player.task is not None:
+            player.task.cancel()
+            player.task = None
+        if player.track is not None and not player.paused:
+            player.started = time.monotonic()
+            player.task = asyncio.create_task(self._playback(session, player))
+
+    def _pause(self, player: _Player):
+        player.position = player.current_position()
+        player.paused = True
+
+    # REST
+
+    @web.middleware
+    async def _auth(self, request: web.Request, handler):
+        if request.headers.get("Authorization") != self.password:
+            raise web.HTTPUnauthorized(text="Unauthorized")
+
+        resource = request.match_info.route.resource
+        key = f"{request.method} {resource.canonical if resource is not None else request.path}"
+        self.requests[key] = self.requests.get(key, 0) + 1
+        return await handler(request)
+
+    async def _version(self, _: web.Request) -> web.Response:
+        return web.Response(text="4.0.0")
+
+    def _session(self, request: web.Request) -> _Session:
+        session = self._sessions.get(request.match_info["session"])
+        if session is None:
+            raise web.HTTPNotFound(text="Session not found")
+        return session
+
+    def _player_payload(self, player: _Player) -> dict:
+        track = None
+        if player.track is not None:
+            track = track_payload({**player.track, "position": player.current_position()})
+        return {
+            "guildId": player.guild_id,
+            "track": track,
+            "volume": 100,
+            "paused": player.paused,
+            "state": {"time": int(time.time() * 1000), "position": player.current_position(),
+                      "connected": player.voice is not None, "ping": 1},
+            "voice": player.voice or {"token": "", "endpoint": "", "sessionId": ""},
+            "filters": {},
+        }
+
+    async def _load_tracks(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self._random.uniform(*self.latency))
+
+        if self._random.random() < self.failure_rate:
+            data = {"loadType": "error",
+                    "data": {"message": "Synthetic failure", "severity": "common", "cause": "fake lavalink"}}
+        else:
+            data = self._resolve(request.query.get("identifier", ""))
+
+        return web.Response(body=orjson.dumps(data), content_type="application/json")
+
+    async def _decode_track(self, request: web.Request) -> web.Response:
+        try:
+            info = decode_track(request.query.get("encodedTrack", ""))
+        except ValueError:
+            raise web.HTTPBadRequest(text="Invalid encoded track")
+
+        return web.Response(body=orjson.dumps(track_payload(info)), content_type="application/json")
+
+    async def _update_session(self, request: web.Request) -> web.Response:
+        session = self._session(request)
+        data = await request.json(loads=orjson.loads)
+        session.resuming = data.get("resuming", session.resuming)
+        session.timeout = data.get("timeout", session.timeout)
+        return web.json_response({"resuming": session.resuming, "timeout": session.timeout})
+
+    async def _get_players(self, request: web.Request) -> web.Response:
+        session = self._session(request)
+        return web.Response(body=orjson.dumps([self._player_payload(p) for p in session.players.values()]),
+                            content_type="application/json")
+
+    async def _get_player(self, request: web.Request) -> web.Response:
+        session = self._session(request)
+        player = session.players.get(request.match_info["guild"])
+        if player is None:
+            raise web.HTTPNotFound(text="Player not found")
+        return web.Response(body=orjson.dumps(self._player_payload(player)), content_type="application/json")
+
+    async def _update_player(self, request: web.Request) -> web.Response:
+        session = self._session(request)
+        guild_id = request.match_info["guild"]
+        data = await request.json(loads=orjson.loads)
+
+        player = session.players.get(guild_id)
+        if player is None:
+            player = session.players[guild_id] = _Player(guild_id)
+
+        if "voice" in data:
+            player.voice = data["voice"]
+            await self._player_update(session, player)
+
+        if "paused" in data and data["paused"] != player.paused:
+            if data["paused"]:
+                self._pause(player)
+            else:
+                player.paused = False
+            self._schedule(session, player)
+
+        no_replace = request.query.get("noReplace") == "true"
+        if "encodedTrack" in data and not (no_replace and player.track is not None):
+            old = player.track
+            player.track = None if data["encodedTrack"] is None else decode_track(data["encodedTrack"])
+            player.position = data.get("position", 0)
+
+            if old is not None:
+                reason = "replaced" if player.track is not None else "stopped"
+                await self._event(session, player, "TrackEndEvent", old, reason=reason)
+            if player.track is not None:
+                await self._event(session, player, "TrackStartEvent", player.track)
+            self._schedule(session, player)
+        elif "position" in data and player.track is not None:
+            player.position = data["position"]
+            self._schedule(session, player)
+
+        return web.Response(body=orjson.dumps(self._player_payload(player)), content_type="application/json")
+
+    async def _destroy_player(self, request: web.Request) -> web.Response:
+        session = self._session(request)
+        player = session.players.pop(request.match_info["guild"], None)
+        if player is not None and player.task is not None:
+            player.task.cancel()
+        return web.Response(status=204)
+
+
+async def serve(server: FakeLavalink):
+    await server.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2333)
+    parser.add_argument("--password", default="youshallnotpass")
+    parser.add_argument("--latency", type=float, nargs=2, default=(0.02, 0.2), metavar=("MIN", "MAX"),
+                        help="track loading latency range, in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--stuck-rate", type=float, default=0.0)
+    parser.add_argument("--speed", type=float, default=1.0, help="playback speed factor")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(name)s: %(message)s")
+    server = FakeLavalink(host=args.host, port=args.port, password=args.password, latency=tuple(args.latency),
+                          failure_rate=args.failure_rate, stuck_rate=args.stuck_rate, speed=args.speed)
+
+    try:
+        asyncio.run(serve(server))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
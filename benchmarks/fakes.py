@@ -0,0 +1,114 @@
+"""Synthetic mafic and discord objects used by the benchmarks"""
+import random
+
+import discord
+from discord.enums import try_enum
+from mafic import Track, Playlist
+
+SOURCES = ["youtube", "soundcloud", "twitch", "bandcamp"]
+
+
+def fake_track(index: int, length: int | None = None, rnd: random.Random | None = None) -> Track:
+    rnd = rnd or random
+    source = SOURCES[index % len(SOURCES)]
+    return Track(
+        track_id=f"QAAA{index:012d}" + "x" * 100,
+        identifier=f"id{index:08d}",
+        seekable=True,
+        author=f"Author {index % 97}",
+        length=length if length is not None else rnd.randrange(30_000, 600_000),
+        stream=source == "twitch",
+        title=f"Track number {index}",
+        uri=f"https://example.com/watch?v=id{index:08d}",
+        artwork_url=f"https://example.com/art/{index}.jpg",
+        isrc=None,
+        source=source,
+    )
+
+
+def fake_tracks(n: int, seed: int = 0) -> list[Track]:
+    rnd = random.Random(seed)
+    return [fake_track(i, rnd=rnd) for i in range(n)]
+
+
+def fake_playlist(n: int, seed: int = 0, name: str = "Playlist") -> Playlist:
+    playlist = Playlist(info={"name": name, "selectedTrack": 0}, tracks=[], plugin_info={})
+    playlist.tracks = fake_tracks(n, seed)
+    return playlist
+
+
+class FakeGuild:
+    __slots__ = ("id",)
+
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+
+
+class FakeMember:
+    """Member stand-in, status is resolved like in discord.py"""
+    __slots__ = ("id", "guild", "mention", "bot", "_status")
+
+    def __init__(self, member_id: int, guild, mention: str, status: str = "offline"):
+        self.id = member_id
+        self.guild = guild
+        self.mention = mention
+        self.bot = False
+        self._status = status
+
+    @property
+    def status(self) -> discord.Status:
+        return try_enum(discord.Status, self._status)
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int, guild):
+        self.id = channel_id
+        self.guild = guild
+        self.sent = 0
+
+    @property
+    def mention(self) -> str:
+        return f"<#{self.id}>"
+
+    async def send(self, *args, **kwargs):
+        self.sent += 1
+
+
+class FakeBot:
+    def __init__(self):
+        self.channels: dict[int, FakeChannel] = {}
+
+    def get_channel(self, channel_id: int):
+        return self.channels.get(channel_id)
+
+
+def presence_flood(guilds: int, members_per_guild: int, tracked: int, events: int, seed: int = 0):
+    """
+    Build a tracker population and a list of presence updates
+    :return: a tuple (bot, tracking dict, list of (before, after) pairs)
+    """
+    rnd = random.Random(seed)
+    bot = FakeBot()
+
+    guild_objects = [FakeGuild(10_000 + g) for g in range(guilds)]
+    members = [
+        FakeMember(1_000_000 + g * members_per_guild + m, guild, f"<@{m}>")
+        for g, guild in enumerate(guild_objects)
+        for m in range(members_per_guild)
+    ]
+
+    tracking: dict[str, dict[str, str]] = {}
+    for member in rnd.sample(members, tracked):
+        channel = FakeChannel(5_000_000 + member.id, member.guild)
+        bot.channels[channel.id] = channel
+        tracking.setdefault(str(member.guild.id), {})[str(member.id)] = str(channel.id)
+
+    statuses = [status.value for status in discord.Status]
+    pairs = []
+    for _ in range(events):
+        member = rnd.choice(members)
+        before = FakeMember(member.id, member.guild, member.mention, rnd.choice(statuses))
+        after = FakeMember(member.id, member.guild, member.mention, rnd.choice(statuses))
+        pairs.append((before, after))
+
+    return bot, tracking, pairs
@@ -0,0 +1,302 @@
+"""
+Multi-guild load test of the Music cog against local fake lavalink nodes
+
+Run from the repository root with: python -m benchmarks.loadtest --guilds 100 --commands 5
+"""
+import argparse
+import asyncio
+import logging
+import random
+import statistics
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+import discord
+import mafic
+
+from dsmusic.metrics import metrics
+from dsmusic.music.cog import Music
+from dsmusic.music.index import TrackIndex
+from dsmusic.music.player import LavalinkPlayer
+from dsmusic.nodes import ResumingNode, load_strategy
+
+from .fake_lavalink import FakeLavalink
+
+logger = logging.getLogger('dsbot.benchmarks.loadtest')
+
+
+class LoadClient:
+    """The parts of the discord client used by mafic and the Music cog"""
+
+    def __init__(self):
+        self.user = SimpleNamespace(id=1, bot=True)
+        self.shard_count = None
+        self.voice_clients: list[LavalinkPlayer] = []
+        self.guilds: dict[int, "LoadGuild"] = {}
+        self.events: Counter = Counter()
+        # gaps between a finished track and the start of the next one
+        self.gaps: list[float] = []
+        self._ended: dict[int, float] = {}
+        self._listeners: dict[str, list] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def add_cog_listeners(self, cog):
+        for name, method in cog.get_listeners():
+            self._listeners.setdefault(name, []).append(method)
+
+    async def wait_until_ready(self):
+        pass
+
+    def is_closed(self) -> bool:
+        return False
+
+    def get_guild(self, guild_id: int):
+        return self.guilds.get(guild_id)
+
+    def dispatch(self, event: str, *args):
+        self.events[event] += 1
+        if event == "track_end" and args[0].reason == mafic.EndReason.FINISHED and args[0].player.queue.peek():
+            self._ended[args[0].player.guild.id] = time.perf_counter()
+        elif event == "track_start" and args[0].player.guild.id in self._ended:
+            self.gaps.append(time.perf_counter() - self._ended.pop(args[0].player.guild.id))
+        for listener in self._listeners.get(f"on_{event}", ()):
+            task = asyncio.create_task(listener(*args))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+
+class LoadGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.voice_client: LavalinkPlayer | None = None
+        self.channel = voice_channel(guild_id * 10, self)
+
+    def get_channel(self, channel_id: int):
+        return self.channel if channel_id == self.channel.id else None
+
+
+def voice_channel(channel_id: int, guild: LoadGuild) -> discord.VoiceChannel:
+    """A VoiceChannel without state, mafic only accepts real voice channels"""
+    channel = discord.VoiceChannel.__new__(discord.VoiceChannel)
+    channel.id = channel_id
+    channel.guild = guild
+    channel.name = f"voice-{channel_id}"
+    return channel
+
+
+class LoadInteraction:
+    """Records the messages sent by a command"""
+
+    def __init__(self, guild: LoadGuild, user_id: int):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.user = SimpleNamespace(id=user_id, voice=SimpleNamespace(channel=guild.channel))
+        self.messages: list[str] = []
+        self.response = SimpleNamespace(defer=self._noop, send_message=self._send)
+        self.followup = SimpleNamespace(send=self._send)
+
+    async def _noop(self, *_, **__):
+        pass
+
+    async def _send(self, content: str | None = None, **_):
+        self.messages.append(content or "")
+
+    def outcome(self) -> str:
+        message = self.messages[-1] if self.messages else ""
+        if message.startswith("✅"):
+            return "ok"
+        if "Too many requests" in message:
+            return "rejected"
+        if "Timed out" in message:
+            return "timeout"
+        if "No song found" in message:
+            return "no_match"
+        return "error"
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def make_query(rnd: random.Random, distinct: int, url_ratio: float, playlist_ratio: float) -> str:
+    n = rnd.randrange(distinct)
+    roll = rnd.random()
+    if roll < playlist_ratio:
+        return f"https://example.com/playlist?list=PL{n:06d}"
+    if roll < playlist_ratio + url_ratio:
+        return f"https://example.com/watch?v=v{n:09d}"
+    return f"some song {n}"
+
+
+async def connect_player(client: LoadClient, guild: LoadGuild) -> LavalinkPlayer:
+    """Run the voice handshake that discord would trigger, without a gateway"""
+    player = LavalinkPlayer(client, guild.channel)
+    player._session_id = f"session-{guild.id}"
+    await player.on_voice_server_update({"token": "token", "endpoint": "fake.discord.media", "guild_id": guild.id})
+
+    guild.voice_client = player
+    client.voice_clients.append(player)
+
+    if not await player.wait_until_connected(timeout=10):
+        raise RuntimeError(f"Player {guild.id} did not connect")
+    return player
+
+
+async def run(args) -> dict:
+    servers = [
+        FakeLavalink(latency=tuple(args.latency), failure_rate=args.failure_rate, stuck_rate=args.stuck_rate,
+                     speed=args.speed, seed=args.seed + i)
+        for i in range(args.nodes)
+    ]
+    for server in servers:
+        await server.start()
+
+    client = LoadClient()
+    pool = mafic.NodePool(client, default_strategies=[load_strategy])
+    for i, server in enumerate(servers):
+        await pool.add_node(ResumingNode(host=server.host, port=server.port, label=f"FAKE-{i}",
+                                         password=server.password, client=client))
+
+    async def save_players(node: ResumingNode):
+        node.save_players()
+    client._listeners.setdefault("on_node_unavailable", []).append(save_players)
+
+    cog = Music(client)
+    cog.track_index = TrackIndex(":memory:")
+    # the nodes were ready before the cog, there is no snapshot to restore on their next node_ready
+    cog.snapshots.restored = True
+    client.add_cog_listeners(cog)
+
+    guilds = [LoadGuild(1000 + i) for i in range(args.guilds)]
+    for guild in guilds:
+        client.guilds[guild.id] = guild
+    await asyncio.gather(*(connect_player(client, guild) for guild in guilds))
+
+    latencies: dict[str, list[float]] = {"play": [], "skip": [], "gap": []}
+    outcomes: Counter = Counter()
+
+    async def drive(guild: LoadGuild, rnd: random.Random):
+        for i in range(args.commands):
+            interaction = LoadInteraction(guild, user_id=guild.id * 100 + i)
+            name = "skip" if rnd.random() < args.skip_ratio else "play"
+
+            start = time.perf_counter()
+            try:
+                if name == "play":
+                    query = make_query(rnd, args.distinct, args.url_ratio, args.playlist_ratio)
+                    await cog.play.callback(cog, interaction, query)
+                else:
+                    await cog.skip.callback(cog, interaction)
+            except Exception as e:
+                # discord.py would log it and go on, so does the load test
+                logger.error(f"Error in {name} of guild {guild.id}: {e!r}")
+                outcome = "exception"
+            else:
+                outcome = interaction.outcome()
+            latencies[name].append(time.perf_counter() - start)
+            outcomes[(name, outcome)] += 1
+
+            await asyncio.sleep(rnd.expovariate(1 / args.interval) if args.interval > 0 else 0)
+
+    async def outage():
+        await asyncio.sleep(args.outage_at)
+        await (servers[0].restart() if args.outage == "restart" else servers[0].disconnect())
+
+    outage_task = asyncio.create_task(outage()) if args.outage else None
+
+    start = time.perf_counter()
+    await asyncio.gather(*(drive(guild, random.Random(args.seed * 7919 + guild.id)) for guild in guilds))
+    elapsed = time.perf_counter() - start
+
+    # Let the fast forwarded tracks play for a while
+    await asyncio.sleep(args.settle)
+    if outage_task is not None:
+        outage_task.cancel()
+
+    latencies["gap"] = client.gaps
+    result = {
+        "elapsed": elapsed,
+        "latencies": latencies,
+        "outcomes": outcomes,
+        "events": dict(client.events),
+        "requests": Counter(),
+        "cache": cog.track_cache.stats(),
+        "index": cog.track_index.stats(),
+        "prefetch": {k: int(metrics.prefetch.value(k)) for k in ("hit", "miss", "invalid", "error")},
+        "player": {k: int(metrics.player_commands.value(k)) for k in ("sent", "coalesced", "retried", "error")},
+        "resume": {
+            **{k: int(sum(metrics.session_resumes.value(node.label, k) for node in pool.nodes))
+               for k in ("resumed", "lost")},
+            **{f"replay_{k}": int(metrics.player_replays.value(k)) for k in ("ok", "failed")},
+        },
+    }
+    for server in servers:
+        result["requests"].update(server.requests)
+
+    cog.track_index.close()
+    for node in list(pool.label_to_node.values()):
+        await node.close()
+    for server in servers:
+        await server.stop()
+
+    return result
+
+
+def report(result: dict):
+    commands = len(result["latencies"]["play"]) + len(result["latencies"]["skip"])
+    print(f"{commands} commands in {result['elapsed']:.2f}s, {commands / result['elapsed']:,.1f} commands/s")
+    print()
+
+    print(f"{'command':<8} {'count':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9} {'mean ms':>9}")
+    for name, values in result["latencies"].items():
+        if not values:
+            continue
+        ms = [v * 1000 for v in values]
+        print(f"{name:<8} {len(ms):>7} {percentile(ms, 50):>9.1f} {percentile(ms, 90):>9.1f} "
+              f"{percentile(ms, 99):>9.1f} {max(ms):>9.1f} {statistics.fmean(ms):>9.1f}")
+    print()
+
+    print("outcomes:  " + ", ".join(f"{name} {outcome}={n}" for (name, outcome), n in sorted(result["outcomes"].items())))
+    print("events:    " + ", ".join(f"{k}={v}" for k, v in sorted(result["events"].items())))
+    print("lavalink:  " + ", ".join(f"{k}={v}" for k, v in sorted(result["requests"].items())))
+    print("cache:     " + ", ".join(f"{k}={v}" for k, v in result["cache"].items()))
+    print("index:     " + ", ".join(f"{k}={v}" for k, v in result["index"].items()))
+    print("prefetch:  " + ", ".join(f"{k}={v}" for k, v in result["prefetch"].items()))
+    print("player:    " + ", ".join(f"{k}={v}" for k, v in result["player"].items()))
+    print("resume:    " + ", ".join(f"{k}={v}" for k, v in result["resume"].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--guilds", type=int, default=50)
+    parser.add_argument("--commands", type=int, default=5, help="commands sent by each guild")
+    parser.add_argument("--interval", type=float, default=1.0, help="mean pause between the commands of a guild")
+    parser.add_argument("--nodes", type=int, default=1, help="number of fake lavalink nodes")
+    parser.add_argument("--latency", type=float, nargs=2, default=(0.02, 0.2), metavar=("MIN", "MAX"),
+                        help="track loading latency range, in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--stuck-rate", type=float, default=0.0)
+    parser.add_argument("--speed", type=float, default=200.0, help="playback speed factor of the fake nodes")
+    parser.add_argument("--distinct", type=int, default=500, help="number of distinct queries")
+    parser.add_argument("--url-ratio", type=float, default=0.4)
+    parser.add_argument("--playlist-ratio", type=float, default=0.1)
+    parser.add_argument("--skip-ratio", type=float, default=0.1)
+    parser.add_argument("--settle", type=float, default=2.0, help="seconds of playback after the last command")
+    parser.add_argument("--outage", choices=("drop", "restart"),
+                        help="drop the websocket of the first node, or restart it losing its sessions")
+    parser.add_argument("--outage-at", type=float, default=2.0, help="seconds after the start of the outage")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="[%(asctime)s] [%(levelname)s] %(name)s: %(message)s")
+    logging.getLogger('mafic').setLevel(logging.CRITICAL)
+
+    report(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
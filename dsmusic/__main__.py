@@ -5,7 +5,8 @@ import sys
 
 import discord
 
-from .client import Client
+from .client import Client, ShardedClient
+from .diagnostics.monitor import Diagnostics
 
 try:
     import uvloop
@@ -43,6 +44,36 @@ def setup_discord_auxiliary_objects():
     return intents, permissions
 
 
+def setup_low_memory_options() -> dict:
+    """
+    Gateway options of the low memory profile: only the intents of the enabled cogs, members cached only while
+    they are in a voice channel, no message cache and no guild chunking at startup
+    :return: the keyword arguments for the client
+    """
+    from .music.cog import INTENTS as MUSIC_INTENTS
+    from .tracker.cog import INTENTS as TRACKER_INTENTS, RAW_PRESENCES
+
+    intents = discord.Intents(guilds=True)
+    if int(os.getenv("ENABLE_MUSIC", "1")) == 1:
+        intents |= MUSIC_INTENTS
+    if int(os.getenv("ENABLE_TRACKER", "1")) == 1:
+        intents |= TRACKER_INTENTS
+
+    options = {
+        "intents": intents,
+        "member_cache_flags": discord.MemberCacheFlags.from_intents(intents),
+        "max_messages": None,
+        "chunk_guilds_at_startup": False,
+    }
+    if RAW_PRESENCES:
+        # Presence updates of the members that are not cached are only sent as raw events
+        options["enable_raw_presences"] = intents.presences
+    else:
+        # Older discord.py drops the presence updates of uncached members, the tracker needs all of them cached
+        options["chunk_guilds_at_startup"] = intents.presences
+    return options
+
+
 def setup_logging():
     logging.basicConfig(
         level=logging.INFO,
@@ -55,6 +86,23 @@ def setup_logging():
     logging.getLogger('mafic.strategy').setLevel(logging.CRITICAL)
 
 
+def setup_sharding() -> dict:
+    """
+    Read the sharding options from the environment, set by the launcher for each cluster
+    :return: the keyword arguments for the client
+    """
+    if os.getenv("SHARD_COUNT") is None and int(os.getenv("SHARDED", "0")) != 1:
+        return {}
+
+    options = {"cluster_id": int(os.getenv("CLUSTER_ID", "0"))}
+    if os.getenv("SHARD_COUNT"):
+        options["shard_count"] = int(os.getenv("SHARD_COUNT"))
+    if os.getenv("SHARD_IDS"):
+        options["shard_ids"] = [int(i) for i in os.getenv("SHARD_IDS").split(",")]
+
+    return options
+
+
 def main():
     setup_logging()
 
@@ -63,8 +111,16 @@ def main():
 
     intents, permissions = setup_discord_auxiliary_objects()
 
-    client = Client(
-        intents=intents,
+    gateway = {"intents": intents}
+    if int(os.getenv("LOW_MEMORY", "0")) == 1:
+        gateway = setup_low_memory_options()
+
+    sharding = setup_sharding()
+    client_cls = ShardedClient if sharding else Client
+
+    client = client_cls(
+        **sharding,
+        **gateway,
         command_prefix="!",
         activity=discord.CustomActivity(name="Gressinbon"),
         status=discord.Status.online,
@@ -72,6 +128,10 @@ def main():
         help_command=None
     )
 
+    # Started by the client once the event loop is running
+    if int(os.getenv("ENABLE_DIAGNOSTICS", "1")) == 1:
+        client.diagnostics = Diagnostics.from_env()
+
     oauth_url = discord.utils.oauth_url(
         client_id=839827510761488404,
         guild=discord.Object(os.getenv("DS_GUILD_ID")),
@@ -1,21 +1,51 @@
 import asyncio
-import json
+import hashlib
 import logging
 import os
+import signal
+import sys
+import time
+from itertools import count
 from os import getenv
 
 import discord
 import mafic
+import orjson
 from discord import app_commands
 from discord.ext import commands
-from mafic import NodeAlreadyConnected
+from mafic import NodeAlreadyConnected, NoNodesAvailable, Strategy
+
+from .metrics import MetricsServer, metrics
+from .nodes import NodeConfig, ResumingNode, load_strategy, migrate_player, parse_node_config
+from .storage import write_atomic
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
 
 __all__ = [
-    "Client"
+    "Client",
+    "ShardedClient"
 ]
 
 logger = logging.getLogger('dsbot')
 
+LAVALINK_CONFIG = "config/lavalink.json"
+
+
+def peak_rss() -> int | None:
+    """
+    Get the peak resident set size of the process
+    :return: the size in bytes, None if it is not available
+    """
+    if resource is None:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss if sys.platform == 'darwin' else rss * 1024
+
 
 async def response_after_error(interaction: discord.Interaction, message: str):
     try:
@@ -25,11 +55,26 @@ async def response_after_error(interaction: discord.Interaction, message: str):
 
 
 class Client(commands.Bot):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, cluster_id: int | None = None, **kwargs):
         super().__init__(*args, **kwargs)
+        self._created = time.perf_counter()
+
+        # Index of this process when running multiple shard clusters, see dsmusic.launcher
+        self.cluster_id = cluster_id
 
         # Add nodes
-        self.pool = mafic.NodePool(self)
+        self.pool = mafic.NodePool(self, default_strategies=[Strategy.SHARD, Strategy.LOCATION, load_strategy])
+        self.node_migration_delay = float(getenv("NODE_MIGRATION_DELAY", "5"))
+        # How long lavalink keeps a session playing after losing the websocket, waiting for the bot to resume it
+        self.node_resume_timeout = int(getenv("LAVALINK_RESUME_TIMEOUT", "60"))
+        self._node_tasks: set[asyncio.Task] = set()
+        # guild ids of the players moved away from a node, by node label
+        self._migrated_players: dict[str, dict[int, mafic.Player]] = {}
+        # The nodes of the lavalink config, checked for changes every LAVALINK_CONFIG_INTERVAL seconds (0 disables it)
+        self._config_nodes: dict[NodeConfig, ResumingNode] = {}
+        self._node_config_lock = asyncio.Lock()
+        self.node_config_interval = float(getenv("LAVALINK_CONFIG_INTERVAL", "5"))
+        self._node_config_watcher: asyncio.Task | None = None
 
         # App commands
         self.guild_id = discord.Object(id=getenv("DS_GUILD_ID", 0))
@@ -39,9 +84,40 @@ class Client(commands.Bot):
         self.tracker_enabled = int(getenv("ENABLE_TRACKER", "1")) == 1
         self.music_enabled = int(getenv("ENABLE_MUSIC", "1")) == 1
 
+        # on_ready runs again after every gateway reconnect, these are done once per process
+        self._nodes_initialized = False
+        self._tree_synced = False
+        self.tree_fingerprint_file = getenv("TREE_FINGERPRINT_FILE", "data/command_tree.sha256")
+
+        # Set by main, see dsmusic.diagnostics
+        self.diagnostics = None
+
+        # Metrics endpoint, disabled unless a port is given
+        self.metrics_server = None
+        if getenv("METRICS_PORT"):
+            port = int(getenv("METRICS_PORT")) + (cluster_id or 0)
+            self.metrics_server = MetricsServer(host=getenv("METRICS_HOST", "127.0.0.1"), port=port)
+
     async def setup_hook(self):
+        # Docker stops the container with SIGTERM, close gracefully so the cogs can save their state
+        if sys.platform != 'win32':
+            self.loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+
+        if self.diagnostics is not None:
+            self.diagnostics.start(self.loop)
+
+        if self.metrics_server is not None:
+            metrics.nodes_connected.collect = lambda: [((), len(self.pool.nodes))]
+            metrics.node_players.collect = self._collect_node_players
+            metrics.node_cpu.collect = self._collect_node_cpu
+            metrics.node_frames.collect = self._collect_node_frames
+            await self.metrics_server.start()
+
         logger.info("Loading extensions")
 
+        if self.diagnostics is not None:
+            await self.load_extension("dsmusic.diagnostics.cog")
+
         if self.tracker_enabled:
             await self.load_extension("dsmusic.tracker.cog")
 
@@ -50,69 +126,378 @@ class Client(commands.Bot):
 
         logger.info("Extensions loaded")
 
+    async def close(self):
+        if self._node_config_watcher is not None:
+            self._node_config_watcher.cancel()
+
+        await super().close()
+
+        if self.diagnostics is not None:
+            self.diagnostics.stop()
+
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+
+    def dispatch(self, event_name: str, /, *args, **kwargs):
+        # Counted here, a listener would schedule a task for every gateway event
+        if event_name == "socket_event_type":
+            metrics.gateway_events.inc(args[0])
+
+        super().dispatch(event_name, *args, **kwargs)
+
     async def on_ready(self):
         logger.info(f"Logged in as {self.user}")
 
         # Add lavalink nodes
-        if self.music_enabled:
+        if self.music_enabled and not self._nodes_initialized:
+            self._nodes_initialized = True
             await self.add_nodes()
 
+            if self.node_config_interval > 0:
+                self._node_config_watcher = asyncio.create_task(self.watch_node_config())
+
             if len(self.pool.nodes) == 0:
                 logger.warning("Disabling music cog")
                 self.music_enabled = False
 
+        # With multiple clusters the commands are synced by the first one
+        if not self._tree_synced and not self.cluster_id:
+            await self.sync_tree()
+
+        # Logged once, to compare the startup cost of the gateway profiles
+        if self._created is not None:
+            elapsed, rss = time.perf_counter() - self._created, peak_rss()
+            self._created = None
+
+            memory = f", peak RSS {rss / 2 ** 20:.1f} MiB" if rss is not None else ""
+            logger.info(f"Ready in {elapsed:.2f}s{memory}")
+
+    def command_tree_fingerprint(self) -> str:
+        """
+        Hash the payload of the guild commands, it changes only when the commands change
+        :return: the hex digest of the payload
+        """
+        payload = sorted(
+            (command.to_dict(self.tree) for command in self.tree.get_commands(guild=self.guild_id)),
+            key=lambda c: (c.get("type", 1), c["name"])
+        )
+        data = orjson.dumps({
+            "application": self.application_id,
+            "guild": self.guild_id.id,
+            "commands": payload,
+        }, option=orjson.OPT_SORT_KEYS)
+
+        return hashlib.sha256(data).hexdigest()
+
+    async def sync_tree(self):
+        """Sync the command tree with discord, only if the commands changed since the last sync"""
         # This copies the global commands over to your guild.
-        logger.info("Syncing command tree")
         self.tree.copy_global_to(guild=self.guild_id)
-        await self.tree.sync(guild=self.guild_id)
+
+        fingerprint = self.command_tree_fingerprint()
+        try:
+            with open(self.tree_fingerprint_file) as f:
+                stored = f.read().strip()
+        except OSError:
+            stored = None
+
+        if fingerprint == stored:
+            logger.info("Command tree unchanged, skipping sync")
+        else:
+            logger.info("Syncing command tree")
+            await self.tree.sync(guild=self.guild_id)
+            try:
+                await self.loop.run_in_executor(
+                    None, write_atomic, self.tree_fingerprint_file, fingerprint.encode())
+            except OSError as e:
+                logger.error(f"Could not store the command tree fingerprint: {e}")
+
+        self._tree_synced = True
 
     async def add_nodes(self):
-        """Add and connect to lavalink nodes"""
+        """Add and connect to lavalink nodes, returning as soon as the first one is available"""
         # noinspection PyShadowingNames
         logger = logging.getLogger('dsbot.lavalink')
         logger.info("Adding lavalink nodes")
 
-        if os.path.exists("config/lavalink.json") and os.path.isfile("config/lavalink.json"):
-            with open("config/lavalink.json") as f:
-                data = json.load(f)
-        elif os.path.isdir("config/lavalink.json"):
+        if os.path.exists(LAVALINK_CONFIG) and os.path.isfile(LAVALINK_CONFIG):
+            try:
+                configs = self.read_node_config()
+            except ValueError as e:
+                logger.error(f"Invalid lavalink config: {e}")
+                return
+        elif os.path.isdir(LAVALINK_CONFIG):
             logger.error("Lavalink config is a directory")
             return
         else:
-            with open("config/lavalink.json", "w") as f:
+            with open(LAVALINK_CONFIG, "w") as f:
                 f.write("[]")
             logger.error("Lavalink config not available")
             return
 
-        for node_info in data:
-            try:
-                async with asyncio.timeout(10):
-                    await self.pool.create_node(
-                        host=node_info["uri"],
-                        port=node_info["port"],
-                        label=f"CONFIG-{data.index(node_info)}",
-                        password=node_info["password"],
-                        secure=False,
-                        timeout=5,
-                    )
-                    logger.info(f"Node {node_info['uri']} added")
-            except NodeAlreadyConnected:
-                pass
-            except (TimeoutError, asyncio.TimeoutError) as e:
-                logger.error(f"Node {node_info['uri']}:{node_info['port']} timed out. {e}")
-            except RuntimeError as e:
-                logger.error(f"Node {node_info['uri']}:{node_info['port']} failed. {e}")
-            except Exception as e:
-                logger.error(e)
+        pending = self._connect_nodes(configs)
+
+        # The remaining nodes keep connecting in the background
+        while pending and len(self.pool.nodes) == 0:
+            _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
 
         if len(self.pool.nodes) == 0:
             logger.error("No nodes connected")
         else:
-            logger.info(f"{len(self.pool.nodes)} nodes connected")
+            logger.info(f"{len(self.pool.nodes)} nodes connected, {len(pending)} still connecting")
+
+    @staticmethod
+    def read_node_config() -> list[NodeConfig]:
+        """
+        Read and validate the lavalink config
+        :return: the configured nodes, ValueError is raised if the file can't be read or is invalid
+        """
+        try:
+            with open(LAVALINK_CONFIG, "rb") as f:
+                return parse_node_config(orjson.loads(f.read()))
+        except OSError as e:
+            raise ValueError(e) from e
+
+    def _connect_nodes(self, configs: list[NodeConfig]) -> set[asyncio.Task]:
+        """Start connecting to nodes, each one gets the first free label"""
+        used = {node.label for node in self._config_nodes.values()} | set(self.pool.label_to_node)
+        labels = (f"CONFIG-{i}" for i in count() if f"CONFIG-{i}" not in used)
+
+        tasks = set()
+        for config, label in zip(configs, labels):
+            node = ResumingNode(
+                host=config.uri,
+                port=config.port,
+                label=label,
+                password=config.password,
+                client=self,
+                secure=False,
+                timeout=5,
+                resume_timeout=self.node_resume_timeout,
+            )
+            self._config_nodes[config] = node
+
+            task = asyncio.create_task(self.add_node(config, node))
+            self._node_tasks.add(task)
+            task.add_done_callback(self._node_tasks.discard)
+            tasks.add(task)
+        return tasks
+
+    async def add_node(self, config: NodeConfig, node: ResumingNode):
+        """Connect to a single lavalink node"""
+        # noinspection PyShadowingNames
+        logger = logging.getLogger('dsbot.lavalink')
+
+        try:
+            async with asyncio.timeout(10):
+                await self.pool.add_node(node)
+                logger.info(f"Node {config.uri} added")
+        except NodeAlreadyConnected:
+            return
+        except (TimeoutError, asyncio.TimeoutError) as e:
+            logger.error(f"Node {config.uri}:{config.port} timed out. {e}")
+        except RuntimeError as e:
+            logger.error(f"Node {config.uri}:{config.port} failed. {e}")
+        except Exception as e:
+            logger.error(e)
+        else:
+            # Removed from the config while connecting
+            if self._config_nodes.get(config) is not node:
+                self.pool.label_to_node.pop(node.label, None)
+                await node.close()
+            return
+
+        # Forget the node, so the next config change tries it again
+        if self._config_nodes.get(config) is node:
+            del self._config_nodes[config]
+        try:
+            await node.close()
+        except Exception as e:
+            logger.debug(f"Error closing node {node.label}: {e}")
+
+    async def watch_node_config(self):
+        """Reload the lavalink config when the file changes"""
+        # noinspection PyShadowingNames
+        logger = logging.getLogger('dsbot.lavalink')
+
+        def stat():
+            try:
+                result = os.stat(LAVALINK_CONFIG)
+                return result.st_mtime_ns, result.st_size
+            except OSError:
+                return None
+
+        last, changed = stat(), None
+        while not self.is_closed():
+            await asyncio.sleep(self.node_config_interval)
+
+            current = stat()
+            if current == last or current is None:
+                changed = None
+                continue
+            # Wait for the file to stay the same for a whole interval, an editor may still be writing it
+            if current != changed:
+                changed = current
+                continue
+
+            last, changed = current, None
+            try:
+                await self.reload_nodes()
+            except Exception as e:
+                logger.error(f"Failed to reload the lavalink config: {e}")
+
+    async def reload_nodes(self) -> bool:
+        """
+        Apply the lavalink config again: connect the new nodes, then move the players off the removed ones and close
+        them. Nodes whose address or password changed are replaced.
+        :return: False if the config is invalid, nothing is changed in that case
+        """
+        # noinspection PyShadowingNames
+        logger = logging.getLogger('dsbot.lavalink')
+
+        try:
+            configs = self.read_node_config()
+        except ValueError as e:
+            logger.error(f"Invalid lavalink config, keeping the current nodes: {e}")
+            return False
+        if not configs:
+            logger.error("The lavalink config has no nodes, keeping the current nodes")
+            return False
+
+        async with self._node_config_lock:
+            wanted = set(configs)
+            added = [config for config in configs if config not in self._config_nodes]
+            removed = [self._config_nodes.pop(config) for config in list(self._config_nodes) if config not in wanted]
+            if not added and not removed:
+                return True
+
+            logger.info(f"Lavalink config changed: {len(added)} node(s) added, {len(removed)} removed")
+
+            # The players of the removed nodes need somewhere to go
+            pending = self._connect_nodes(added)
+            if pending:
+                await asyncio.wait(pending)
+
+            await asyncio.gather(*(self.drain_node(node) for node in removed))
+
+        logger.info(f"{len(self.pool.nodes)} nodes connected")
+        return True
+
+    async def drain_node(self, node: mafic.Node):
+        """Move the players of a node to the other nodes, then close it"""
+        # noinspection PyShadowingNames
+        logger = logging.getLogger('dsbot.lavalink')
+
+        # Out of the pool first, so it is not picked for the players
+        self.pool.label_to_node.pop(node.label, None)
+        self._migrated_players.pop(node.label, None)
+
+        async def move(player: mafic.Player):
+            try:
+                target = self.pool.get_node(guild_id=player.guild.id, endpoint=player.endpoint)
+                # An offline node can't tell the current state, use the one saved when it went down
+                state = None
+                if not node.available and isinstance(node, ResumingNode):
+                    state = node.saved_state(player.guild.id)
+                await migrate_player(player, target, state)
+            except Exception as e:
+                logger.error(f"Failed to move player {player.guild.id} off node {node.label}, disconnecting it: {e}")
+                try:
+                    await player.disconnect(force=True)
+                except Exception as e:
+                    logger.error(f"Failed to disconnect player {player.guild.id}: {e}")
+                return
+
+            if node.available:
+                try:
+                    await node.destroy(player.guild.id)
+                except Exception as e:
+                    logger.debug(f"Failed to destroy player {player.guild.id} on node {node.label}: {e}")
+
+        await asyncio.gather(*(move(player) for player in node.players))
+        await node.close()
+        logger.info(f"Node {node.label} removed")
+
+    async def on_node_unavailable(self, node: mafic.Node):
+        """Move the players of a disconnected node to the healthy ones"""
+        # noinspection PyShadowingNames
+        logger = logging.getLogger('dsbot.lavalink')
+        logger.warning(f"Node {node.label} is unavailable")
+        if isinstance(node, ResumingNode):
+            node.save_players()
+
+        # Give the node a chance to reconnect before moving the players
+        await asyncio.sleep(self.node_migration_delay)
+        if node.available or len(node.players) == 0:
+            return
+
+        migrated = self._migrated_players.setdefault(node.label, {})
+
+        async def migrate(player: mafic.Player):
+            try:
+                target = self.pool.get_node(guild_id=player.guild.id, endpoint=player.endpoint)
+                state = node.saved_state(player.guild.id) if isinstance(node, ResumingNode) else None
+                await migrate_player(player, target, state)
+                migrated[player.guild.id] = player
+            except NoNodesAvailable:
+                logger.error(f"No node available for player {player.guild.id}")
+            except Exception as e:
+                logger.error(f"Failed to move player {player.guild.id}: {e}")
+
+        await asyncio.gather(*(migrate(player) for player in node.players))
+
+    async def on_node_ready(self, node: mafic.Node):
+        """Drop the stale copies of the players that were moved away while the node was offline"""
+        migrated = self._migrated_players.pop(node.label, {})
+
+        for guild_id, player in migrated.items():
+            stale = node.get_player(guild_id)
+            if stale is None or stale is player:
+                continue
+
+            node.remove_player(guild_id)
+            try:
+                await node.destroy(guild_id)
+            except Exception as e:
+                logging.getLogger('dsbot.lavalink').error(f"Failed to destroy stale player {guild_id}: {e}")
+
+            # The node registered its own copy as voice client while syncing, restore ours
+            # noinspection PyProtectedMember
+            key, _ = player.channel._get_voice_client_key()
+            # noinspection PyProtectedMember
+            self._connection._add_voice_client(key, player)
+
+    def _collect_node_players(self):
+        for node in self.pool.nodes:
+            yield (node.label, "connected"), len(node.players)
+            if node.stats is not None:
+                yield (node.label, "playing"), node.stats.playing_player_count
+                yield (node.label, "total"), node.stats.player_count
+
+    def _collect_node_cpu(self):
+        for node in self.pool.nodes:
+            if node.stats is not None:
+                yield (node.label, "lavalink"), node.stats.cpu.lavalink_load
+                yield (node.label, "system"), node.stats.cpu.system_load
+
+    def _collect_node_frames(self):
+        for node in self.pool.nodes:
+            if node.stats is not None and node.stats.frame_stats is not None:
+                yield (node.label, "sent"), node.stats.frame_stats.sent
+                yield (node.label, "nulled"), node.stats.frame_stats.nulled
+                yield (node.label, "deficit"), node.stats.frame_stats.deficit
+
+    async def on_app_command_completion(self, interaction: discord.Interaction, command: app_commands.Command):
+        latency = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+        metrics.command_latency.observe(latency, command.qualified_name, "ok")
 
     # noinspection PyUnresolvedReferences
     @staticmethod
     async def on_tree_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+        if interaction.command is not None:
+            latency = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+            metrics.command_latency.observe(latency, interaction.command.qualified_name, "error")
+
         if isinstance(error, app_commands.CommandOnCooldown):
             return await response_after_error(interaction, f"You are currently on cooldown!")
         elif isinstance(error, app_commands.MissingPermissions):
@@ -121,3 +506,11 @@ class Client(commands.Bot):
         else:
             logger.error(error)
             return await response_after_error(interaction, "An error occurred")
+
+
+class ShardedClient(Client, commands.AutoShardedBot):
+    """
+    Client running a set of shards in one process
+
+    Every guild is handled by the process running its shard, so the players and their queues never leave it.
+    """
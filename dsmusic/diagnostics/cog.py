@@ -0,0 +1,41 @@
+import logging
+
+import discord
+from discord import app_commands
+from discord.ext import commands
+
+logger = logging.getLogger('dsbot.diagnostics.cog')
+
+
+@app_commands.guild_only()
+@app_commands.default_permissions(administrator=True)
+class Diagnostics(commands.Cog):
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+
+    @app_commands.command(name="profile", description="Profile the bot and send a flamegraph-compatible dump")
+    @app_commands.describe(seconds="How long to sample the event loop")
+    async def profile(self, interaction: discord.Interaction, seconds: app_commands.Range[int, 1, 120] = 10):
+        """Owner only: run the sampling profiler"""
+        # noinspection PyTypeChecker
+        resp: discord.InteractionResponse = interaction.response
+
+        if not await self.bot.is_owner(interaction.user):
+            return await resp.send_message("❌ Only the bot owner can use this command", ephemeral=True)
+
+        diagnostics = getattr(self.bot, "diagnostics", None)
+        if diagnostics is None:
+            return await resp.send_message("❌ Diagnostics are not enabled", ephemeral=True)
+        if diagnostics.profiler.running:
+            return await resp.send_message("✴️ A profile is already running", ephemeral=True)
+
+        await resp.defer(ephemeral=True, thinking=True)
+
+        path = await diagnostics.profile(seconds)
+        await interaction.followup.send(f"✅ Profiled for {seconds}s", file=discord.File(path), ephemeral=True)
+
+
+async def setup(bot: commands.Bot) -> None:
+    logger.debug("Loading diagnostics cog")
+    await bot.add_cog(Diagnostics(bot))
+    logger.info("Diagnostics cog loaded")
@@ -0,0 +1,132 @@
+import asyncio
+import inspect
+import logging
+import sys
+import threading
+import time
+import traceback
+from os import getenv
+
+from ..metrics import Histogram, metrics
+from .profiler import SamplingProfiler
+
+__all__ = [
+    "Diagnostics"
+]
+
+
+logger = logging.getLogger('dsbot.diagnostics')
+
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _blocking_coroutine(frame) -> str | None:
+    """Find the innermost coroutine in a stack"""
+    while frame is not None:
+        if frame.f_code.co_flags & inspect.CO_COROUTINE:
+            return frame.f_code.co_qualname
+        frame = frame.f_back
+    return None
+
+
+class Diagnostics:
+    """
+    Event loop health monitoring
+
+    A callback scheduled every `interval` seconds measures the loop lag. A watchdog thread checks that the callback
+    keeps running: when the loop is blocked for more than `threshold` seconds, the stack of the loop thread is
+    logged together with the coroutine that is running. Both work with any event loop, uvloop included.
+    """
+
+    def __init__(self, interval: float = 0.1, threshold: float = 0.25, profile_seconds: float = 0,
+                 profile_interval: float = 0.005, profile_dir: str = "data/profiles"):
+        self.interval = interval
+        self.threshold = threshold
+        self.profile_seconds = profile_seconds
+        self.profile_dir = profile_dir
+
+        self.profiler = SamplingProfiler(interval=profile_interval)
+        self.lag: Histogram = metrics.register(Histogram(
+            "dsbot_event_loop_lag_seconds", "Delay of the scheduled callbacks on the event loop", buckets=LAG_BUCKETS))
+
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._handle: asyncio.TimerHandle | None = None
+        self._expected = 0.0
+        self._heartbeat = 0.0
+        self._stalled_since: float | None = None
+        self._stop = threading.Event()
+        self._watchdog: threading.Thread | None = None
+
+    @classmethod
+    def from_env(cls) -> "Diagnostics":
+        return cls(
+            threshold=float(getenv("LOOP_LAG_THRESHOLD", "250")) / 1000,
+            profile_seconds=float(getenv("PROFILE_SECONDS", "0")),
+            profile_interval=float(getenv("PROFILE_INTERVAL", "5")) / 1000,
+        )
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """
+        Start the monitoring, must be called from the loop thread
+        :param loop: the running event loop
+        """
+        self._loop = loop
+        self.profiler.thread_id = threading.get_ident()
+
+        self._heartbeat = time.monotonic()
+        self._expected = self._heartbeat + self.interval
+        self._handle = loop.call_later(self.interval, self._tick)
+
+        self._stop.clear()
+        self._watchdog = threading.Thread(target=self._watch, name="dsbot loop watchdog", daemon=True)
+        self._watchdog.start()
+
+        if self.profile_seconds > 0:
+            loop.create_task(self.profile(self.profile_seconds))
+
+        logger.info(f"Event loop monitor started ({type(loop).__module__}.{type(loop).__name__})")
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._stop.set()
+
+    def _tick(self):
+        now = time.monotonic()
+        lag = max(now - self._expected, 0.0)
+        self.lag.observe(lag)
+
+        if self._stalled_since is not None:
+            logger.warning(f"Event loop was blocked for {lag * 1000:.0f} ms")
+            self._stalled_since = None
+
+        self._heartbeat = now
+        self._expected = now + self.interval
+        self._handle = self._loop.call_later(self.interval, self._tick)
+
+    def _watch(self):
+        while not self._stop.wait(self.threshold / 2):
+            stalled = time.monotonic() - self._heartbeat - self.interval
+            if stalled < self.threshold or self._stalled_since is not None:
+                continue
+
+            self._stalled_since = self._heartbeat
+            frame = sys._current_frames().get(self.profiler.thread_id)
+            if frame is None:
+                continue
+
+            coroutine = _blocking_coroutine(frame) or "no coroutine"
+            stack = "".join(traceback.format_stack(frame))
+            logger.warning(f"Event loop blocked for more than {stalled * 1000:.0f} ms in {coroutine}\n{stack}")
+
+    async def profile(self, seconds: float) -> str:
+        """
+        Run the sampling profiler on the loop thread and write a flamegraph-compatible profile
+        :param seconds: how long to sample
+        :return: the path of the profile
+        """
+        path = f"{self.profile_dir}/profile-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+        samples = await asyncio.get_running_loop().run_in_executor(None, self.profiler.dump, seconds, path)
+        logger.info(f"Profile with {samples} samples written to {path}")
+        return path
@@ -0,0 +1,75 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+__all__ = [
+    "SamplingProfiler",
+    "format_frame"
+]
+
+
+def format_frame(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """
+    Sample the stack of a thread at a fixed interval
+
+    The result is in the folded format used by flamegraph.pl and speedscope: one line per stack, frames from the
+    root to the leaf separated by semicolons, followed by the number of samples.
+    """
+
+    def __init__(self, thread_id: int | None = None, interval: float = 0.005):
+        self.thread_id = thread_id if thread_id is not None else threading.main_thread().ident
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def sample(self, seconds: float) -> Counter[str]:
+        """
+        Sample the thread, blocking the calling thread for the given time
+        :param seconds: how long to sample
+        :return: the number of samples for each folded stack
+        """
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("The profiler is already running")
+
+        stacks: Counter[str] = Counter()
+        try:
+            end = time.monotonic() + seconds
+            while time.monotonic() < end:
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is not None:
+                    frames = []
+                    while frame is not None:
+                        frames.append(format_frame(frame))
+                        frame = frame.f_back
+                    stacks[";".join(reversed(frames))] += 1
+                time.sleep(self.interval)
+        finally:
+            self._lock.release()
+
+        return stacks
+
+    def dump(self, seconds: float, path: str) -> int:
+        """
+        Sample the thread and write the folded stacks to a file
+        :param seconds: how long to sample
+        :param path: the destination file
+        :return: the number of samples
+        """
+        stacks = self.sample(seconds)
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        return sum(stacks.values())
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+import aiohttp
+
+__all__ = [
+    "fetch_shard_count",
+    "split_shards",
+    "Launcher"
+]
+
+
+logger = logging.getLogger('dsbot.launcher')
+
+# Discord allows one identify every 5 seconds for each bucket
+IDENTIFY_DELAY = 5
+
+
+async def _fetch_shard_count(token: str) -> int:
+    async with aiohttp.ClientSession() as session:
+        async with session.get("https://discord.com/api/v10/gateway/bot",
+                               headers={"Authorization": f"Bot {token}"}) as response:
+            response.raise_for_status()
+            data = await response.json()
+    return int(data["shards"])
+
+
+def fetch_shard_count(token: str) -> int:
+    """
+    Ask discord the recommended number of shards
+    :param token: the bot token
+    :return: the number of shards
+    """
+    return asyncio.run(_fetch_shard_count(token))
+
+
+def split_shards(shard_count: int, clusters: int) -> list[list[int]]:
+    """
+    Split the shard ids in contiguous groups of similar size
+    :param shard_count: the total number of shards
+    :param clusters: the number of groups
+    :return: the shard ids of each group
+    """
+    clusters = max(1, min(clusters, shard_count))
+    size, extra = divmod(shard_count, clusters)
+
+    groups = []
+    start = 0
+    for i in range(clusters):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(list(range(start, end)))
+        start = end
+    return groups
+
+
+def _run_cluster(cluster_id: int, shard_count: int, shard_ids: list[int], delay: float):
+    os.environ["CLUSTER_ID"] = str(cluster_id)
+    os.environ["SHARD_COUNT"] = str(shard_count)
+    os.environ["SHARD_IDS"] = ",".join(map(str, shard_ids))
+
+    # Stagger the clusters so their identify calls do not hit the rate limit together
+    time.sleep(delay)
+
+    from .__main__ import main
+    main()
+
+
+class Launcher:
+    """
+    Run the bot as one process for each group of shards and restart the processes that crash
+
+    Every guild belongs to a single shard, so the players and all the per guild state stay in one process.
+    """
+
+    def __init__(self, shard_count: int, clusters: int, max_backoff: float = 300, stable_after: float | None = None):
+        self.shard_count = shard_count
+        self.groups = split_shards(shard_count, clusters)
+        self.max_backoff = max_backoff
+        # a cluster that ran this long before exiting is restarted with the shortest backoff again
+        self.stable_after = max_backoff if stable_after is None else stable_after
+
+        self._context = multiprocessing.get_context("spawn")
+        self._processes: dict[int, multiprocessing.Process] = {}
+        self._restarts: dict[int, int] = {}
+        # when each cluster starts running, after its delay
+        self._started: dict[int, float] = {}
+        self._closing = False
+
+    def _start(self, cluster_id: int, delay: float):
+        process = self._context.Process(
+            target=_run_cluster, name=f"dsbot-cluster-{cluster_id}",
+            args=(cluster_id, self.shard_count, self.groups[cluster_id], delay)
+        )
+        process.start()
+        self._processes[cluster_id] = process
+        self._started[cluster_id] = time.monotonic() + delay
+        logger.info(f"Started cluster {cluster_id} (shards {self.groups[cluster_id]}) pid {process.pid}")
+
+    def _stop(self, *_):
+        self._closing = True
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        shards_before = 0
+        for cluster_id, shard_ids in enumerate(self.groups):
+            self._start(cluster_id, shards_before * IDENTIFY_DELAY)
+            shards_before += len(shard_ids)
+
+        while not self._closing:
+            for cluster_id, process in list(self._processes.items()):
+                if process.is_alive() or self._closing:
+                    continue
+
+                uptime = time.monotonic() - self._started[cluster_id]
+                restarts = 0 if uptime >= self.stable_after else self._restarts.get(cluster_id, 0)
+                delay = min(self.max_backoff, IDENTIFY_DELAY * 2 ** restarts)
+                self._restarts[cluster_id] = restarts + 1
+
+                logger.error(f"Cluster {cluster_id} exited with code {process.exitcode}, restarting in {delay}s")
+                self._start(cluster_id, delay)
+
+            time.sleep(1)
+
+        for process in self._processes.values():
+            process.join(timeout=30)
+            if process.is_alive():
+                process.kill()
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] [%(levelname)s] %(name)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+    shard_count = os.getenv("SHARD_COUNT")
+    if shard_count:
+        shard_count = int(shard_count)
+    else:
+        token = os.getenv("DS_TOKEN")
+        if not token:
+            raise ValueError("Missing token")
+        shard_count = fetch_shard_count(token)
+
+    clusters = int(os.getenv("SHARD_CLUSTERS", str(os.cpu_count() or 1)))
+
+    Launcher(shard_count, clusters).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+import logging
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+from aiohttp import web
+
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "MetricsServer",
+    "Registry",
+    "metrics"
+]
+
+
+logger = logging.getLogger('dsbot.metrics')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Labels, values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Labels = (),
+                 collect: Callable[[], Iterable[tuple[Labels, float]]] | None = None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        # values read from their owner when the metrics are scraped
+        self.collect = collect
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def _collected(self, values: dict[Labels, float]) -> dict[Labels, float]:
+        values = dict(values)
+        if self.collect is not None:
+            try:
+                values.update(self.collect())
+            except Exception as e:
+                logger.error(f"Error collecting {self.name}: {e}")
+        return values
+
+    @abstractmethod
+    def render(self) -> list[str]:
+        """
+        Render the metric in the Prometheus text format
+        :return: the lines of the metric
+        """
+
+
+class Counter(_Metric):
+    """A counter incremented with inc, or whose values are collected by a callback when the metrics are scraped"""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Labels = (),
+                 collect: Callable[[], Iterable[tuple[Labels, float]]] | None = None):
+        super().__init__(name, documentation, labels, collect)
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> list[str]:
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}"
+            for labels, value in self._collected(self._values).items()
+        ]
+
+
+class Gauge(_Metric):
+    """A gauge whose values are collected by a callback when the metrics are scraped"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Labels = (),
+                 collect: Callable[[], Iterable[tuple[Labels, float]]] | None = None):
+        super().__init__(name, documentation, labels, collect)
+        self._values: dict[Labels, float] = {}
+
+    def set(self, value: float, *labels: str):
+        self._values[labels] = value
+
+    def render(self) -> list[str]:
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}"
+            for labels, value in self._collected(self._values).items()
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Labels = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: counts for each bucket (not cumulative), sum, count
+        self._values: dict[Labels, list] = {}
+
+    def observe(self, value: float, *labels: str):
+        data = self._values.get(labels)
+        if data is None:
+            data = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+        data[0][bisect_left(self.buckets, value)] += 1
+        data[1] += value
+        data[2] += 1
+
+    def count(self, *labels: str) -> int:
+        data = self._values.get(labels)
+        return data[2] if data else 0
+
+    def render(self) -> list[str]:
+        lines = self.header()
+
+        for labels, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {count}")
+
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name: str) -> _Metric | None:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class _Metrics(Registry):
+    """The metrics exported by the bot"""
+
+    def __init__(self):
+        super().__init__()
+
+        self.command_latency: Histogram = self.register(Histogram(
+            "dsbot_command_latency_seconds", "Time from the interaction creation to the command completion",
+            ("command", "status")))
+        self.fetch_latency: Histogram = self.register(Histogram(
+            "dsbot_fetch_tracks_latency_seconds", "Latency of the lavalink fetch_tracks requests", ("result",)))
+        self.fetch_timeouts: Counter = self.register(Counter(
+            "dsbot_fetch_tracks_timeouts_total", "fetch_tracks calls that timed out"))
+        self.play_to_audio: Histogram = self.register(Histogram(
+            "dsbot_play_to_first_audio_seconds", "Time from a /play command to the start of the first track"))
+        self.voice_connect: Histogram = self.register(Histogram(
+            "dsbot_voice_connect_seconds", "Time from a voice connect to the lavalink player being connected"))
+        self.gateway_events: Counter = self.register(Counter(
+            "dsbot_gateway_events_total", "Gateway events received, by type", ("type",)))
+        self.track_gap: Histogram = self.register(Histogram(
+            "dsbot_track_gap_seconds", "Time from the end of a track to the start of the next one",
+            buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)))
+        self.prefetch: Counter = self.register(Counter(
+            "dsbot_prefetch_total", "Outcome of the next track prefetch: hit, miss, invalid or error", ("result",)))
+        self.session_resumes: Counter = self.register(Counter(
+            "dsbot_lavalink_session_resumes_total", "Lavalink reconnections, by outcome of the session resume",
+            ("node", "result")))
+        self.player_replays: Counter = self.register(Counter(
+            "dsbot_lavalink_player_replays_total", "Players recreated on a lavalink session that lost them",
+            ("result",)))
+        self.player_commands: Counter = self.register(Counter(
+            "dsbot_player_commands_total",
+            "Play and stop commands asked by the guild executors: sent, coalesced, retried or error", ("result",)))
+        self.resolve_wait: Histogram = self.register(Histogram(
+            "dsbot_resolve_wait_seconds", "Time spent waiting for a lavalink slot before fetch_tracks", ("priority",)))
+        self.resolve_rejections: Counter = self.register(Counter(
+            "dsbot_resolve_rejections_total", "Track resolutions dropped by the scheduler", ("reason",)))
+        self.presence_updates: Counter = self.register(Counter(
+            "dsbot_tracker_presence_updates_total", "Presence updates seen by the tracker", ("result",)))
+
+        self.queue_depth: Gauge = self.register(Gauge(
+            "dsbot_queue_depth", "Number of tracks waiting in the queue", ("guild",)))
+        self.queue_duration: Gauge = self.register(Gauge(
+            "dsbot_queue_duration_seconds", "Total duration of the tracks waiting in the queue", ("guild",)))
+        self.nodes_connected: Gauge = self.register(Gauge(
+            "dsbot_lavalink_nodes_connected", "Number of available lavalink nodes"))
+        self.node_players: Gauge = self.register(Gauge(
+            "dsbot_lavalink_node_players", "Players on each lavalink node", ("node", "state")))
+        self.node_cpu: Gauge = self.register(Gauge(
+            "dsbot_lavalink_node_cpu_load", "CPU load reported by each lavalink node", ("node", "kind")))
+        self.node_frames: Gauge = self.register(Gauge(
+            "dsbot_lavalink_node_frames", "Frame stats reported by each lavalink node for the last minute",
+            ("node", "kind")))
+        self.resolve_requests: Gauge = self.register(Gauge(
+            "dsbot_resolve_requests", "Track resolutions running or waiting on each lavalink node", ("node", "state")))
+        self.track_cache: Gauge = self.register(Gauge(
+            "dsbot_track_cache", "Size of the resolved track cache and of the track index", ("kind",)))
+        self.track_cache_hits: Counter = self.register(Counter(
+            "dsbot_track_cache_hits_total", "Queries answered by the resolved track cache or the track index",
+            ("cache",)))
+        self.track_cache_misses: Counter = self.register(Counter(
+            "dsbot_track_cache_misses_total", "Queries not found in the resolved track cache or the track index",
+            ("cache",)))
+        self.track_cache_coalesced: Counter = self.register(Counter(
+            "dsbot_track_cache_coalesced_total", "Queries that waited for the same query already being resolved"))
+        self.track_cache_evictions: Counter = self.register(Counter(
+            "dsbot_track_cache_evictions_total", "Entries evicted from the resolved track cache"))
+
+
+metrics = _Metrics()
+
+
+class MetricsServer:
+    """Local HTTP endpoint serving the metrics in the Prometheus text format"""
+
+    def __init__(self, registry: Registry = metrics, host: str = "127.0.0.1", port: int = 9100):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner: web.AppRunner | None = None
+
+    async def _handle(self, _: web.Request) -> web.Response:
+        return web.Response(body=self.registry.render().encode(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+from urllib.parse import urlsplit, urlunsplit
+
+from mafic import Track, Playlist
+
+__all__ = [
+    "TrackCache",
+    "normalize_query"
+]
+
+
+logger = logging.getLogger('dsbot.music.cache')
+
+URL_REGEX = re.compile(r"https?://")
+WHITESPACE_REGEX = re.compile(r"\s+")
+
+Result = list[Track] | Playlist | None
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalize a query so that equivalent searches share the same cache key
+    :param query: an URL or a search query
+    :return: the normalized query
+    """
+    query = query.strip()
+
+    if URL_REGEX.match(query):
+        # Video ids are case-sensitive, so only scheme and host are lowered
+        parts = urlsplit(query)
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ""))
+    else:
+        return WHITESPACE_REGEX.sub(" ", query).casefold()
+
+
+def _estimate_size(result: Result) -> int:
+    """
+    Rough estimate of the memory used by a result, in bytes
+    :param result: the result of fetch_tracks
+    :return: the estimated size
+    """
+    if result is None:
+        return 64
+
+    tracks = result.tracks if isinstance(result, Playlist) else result
+    size = 64
+    for track in tracks:
+        size += 256 + len(track.id) + len(track.title) + len(track.author) + len(track.uri or "")
+    return size
+
+
+class _CacheItem:
+    __slots__ = ("result", "expires", "size")
+
+    def __init__(self, result: Result, expires: float, size: int):
+        self.result = result
+        self.expires = expires
+        self.size = size
+
+
+class TrackCache:
+    """
+    Shared LRU cache of resolved queries
+
+    Entries expire after a TTL and the least recently used ones are evicted when the memory budget is exceeded.
+    Empty results are cached with a shorter TTL. Concurrent requests for the same query are coalesced into a
+    single request to lavalink.
+    """
+
+    def __init__(self, ttl: float = 1800, negative_ttl: float = 60, max_size: int = 16 * 1024 * 1024):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+
+        self._items: OrderedDict[str, _CacheItem] = OrderedDict()
+        self._pending: dict[str, asyncio.Future] = {}
+        self._size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def size(self) -> int:
+        """Estimated memory used by the cached results, in bytes"""
+        return self._size
+
+    def stats(self) -> dict[str, int]:
+        """
+        Get the cache counters
+        :return: a dict with the counters
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "entries": len(self._items),
+            "size": self._size,
+        }
+
+    def get(self, query: str) -> tuple[bool, Result]:
+        """
+        Get a result from the cache
+        :param query: the query to look up
+        :return: a tuple (found, result)
+        """
+        key = normalize_query(query)
+        item = self._items.get(key)
+
+        if item is None:
+            return False, None
+        if item.expires < time.monotonic():
+            self._discard(key)
+            return False, None
+
+        self._items.move_to_end(key)
+        return True, item.result
+
+    def put(self, query: str, result: Result):
+        """
+        Store a result in the cache
+        :param query: the query of the result
+        :param result: the result of fetch_tracks
+        """
+        key = normalize_query(query)
+        empty = result is None or (isinstance(result, list) and len(result) == 0)
+        size = _estimate_size(result)
+
+        if size > self.max_size:
+            return
+
+        self._discard(key)
+        self._items[key] = _CacheItem(result, time.monotonic() + (self.negative_ttl if empty else self.ttl), size)
+        self._size += size
+
+        while self._size > self.max_size:
+            _, item = self._items.popitem(last=False)
+            self._size -= item.size
+            self.evictions += 1
+
+    def invalidate(self, query: str):
+        """
+        Remove a query from the cache
+        :param query: the query to remove
+        """
+        self._discard(normalize_query(query))
+
+    def clear(self):
+        self._items.clear()
+        self._size = 0
+
+    def _discard(self, key: str):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._size -= item.size
+
+    async def resolve(self, query: str, fetch: Callable[[str], Awaitable[Result]],
+                      own_errors: tuple[type[Exception], ...] = ()) -> Result:
+        """
+        Resolve a query using the cache, calling fetch only on a miss
+        :param query: an URL or a search query
+        :param fetch: the coroutine function used to resolve the query on a miss
+        :param own_errors: errors of fetch that only concern its caller, like a rate limit: a request coalesced
+        with a failed one resolves the query again with its own fetch instead of raising them
+        :return: the result of fetch_tracks
+        """
+        found, result = self.get(query)
+        if found:
+            self.hits += 1
+            return result
+
+        key = normalize_query(query)
+        pending = self._pending.get(key)
+
+        if pending is not None:
+            self.coalesced += 1
+            # shield the shared request, a timed out waiter must not cancel it for the others
+            try:
+                return await asyncio.shield(pending)
+            except own_errors:
+                # the request is gone from _pending, this one starts or joins the next attempt
+                return await self.resolve(query, fetch, own_errors)
+
+        self.misses += 1
+        task = asyncio.ensure_future(fetch(query))
+        self._pending[key] = task
+
+        def _done(t: asyncio.Future):
+            self._pending.pop(key, None)
+            if not t.cancelled() and t.exception() is None:
+                self.put(query, t.result())
+            elif not t.cancelled():
+                logger.debug(f"Not caching failed query {key!r}: {t.exception()}")
+
+        task.add_done_callback(_done)
+        return await asyncio.shield(task)
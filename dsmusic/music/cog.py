@@ -1,5 +1,7 @@
 import asyncio
 import logging
+import os
+import time
 
 import discord
 import mafic
@@ -7,46 +9,233 @@ from discord import app_commands
 from discord.channel import VocalGuildChannel
 from discord.ext import commands, tasks
 
+from ..metrics import metrics
+from .cache import URL_REGEX, TrackCache
+from .executor import STOP, GuildExecutor
+from .index import TrackIndex
+from .limits import load_limits
 from .player import LavalinkPlayer
+from .reaper import IdleReaper
+from .scheduler import ResolveRejected, ResolveScheduler
+from .snapshot import PlayerSnapshots
+from .views import QueuePages
 
 logger = logging.getLogger('dsbot.music.cog')
 
+# Gateway intents used by the cog, voice states are needed for the players and the channel members
+INTENTS = discord.Intents(guilds=True, voice_states=True)
+
 
 @app_commands.guild_only()
 class Music(commands.Cog):
     def __init__(self, bot: discord.Client):
         self.bot = bot
 
+        # Shared between all the guilds
+        self.track_cache = TrackCache()
+        self.track_index = TrackIndex(os.getenv("TRACK_INDEX_FILE", "data/tracks.db"),
+                                      max_tracks=int(os.getenv("TRACK_INDEX_SIZE", "50000")))
+        self.scheduler = ResolveScheduler(concurrency=int(os.getenv("RESOLVE_CONCURRENCY", "4")))
+        # Orders the skips, track ends and plays of each guild, and merges the player commands of a burst
+        self.executor = GuildExecutor(window=float(os.getenv("PLAY_COALESCE_WINDOW", "0.2")))
+        # Each shard cluster only knows the players of its own guilds
+        cluster_id = getattr(bot, "cluster_id", None)
+        self.snapshots = PlayerSnapshots(
+            bot, "data/players.json" if cluster_id is None else f"data/players-{cluster_id}.json"
+        )
+
+        # Disconnects the players left alone in their channel or not playing
+        self.reaper = IdleReaper(bot, grace=float(os.getenv("VOICE_GRACE_PERIOD", "30")),
+                                 idle=float(os.getenv("IDLE_TIMEOUT", "300")))
+
+        # guild id -> time of the /play that started the playback, used for the time to first audio
+        self._play_started: dict[int, float] = {}
+        # guild id -> time a track ended with another one to play, used for the gap between tracks
+        self._track_ended: dict[int, float] = {}
+
+        metrics.queue_depth.collect = self._collect_queue_depth
+        metrics.queue_duration.collect = self._collect_queue_duration
+        metrics.track_cache.collect = self._collect_track_cache
+        metrics.track_cache_hits.collect = lambda: self._collect_cache_counter("hits")
+        metrics.track_cache_misses.collect = lambda: self._collect_cache_counter("misses")
+        metrics.track_cache_coalesced.collect = lambda: [((), self.track_cache.coalesced)]
+        metrics.track_cache_evictions.collect = lambda: [((), self.track_cache.evictions)]
+        metrics.resolve_requests.collect = self._collect_resolve_requests
+
+    def _players(self):
+        return (vc for vc in self.bot.voice_clients if isinstance(vc, LavalinkPlayer))
+
+    def _collect_queue_depth(self):
+        return [((str(vc.guild.id),), len(vc.queue)) for vc in self._players()]
+
+    def _collect_queue_duration(self):
+        return [((str(vc.guild.id),), vc.queue.duration / 1000) for vc in self._players()]
+
+    def _collect_track_cache(self):
+        cache, index = self.track_cache.stats(), self.track_index.stats()
+        return [(("entries",), cache["entries"]), (("size",), cache["size"]), (("index_tracks",), index["tracks"])]
+
+    def _collect_cache_counter(self, name: str):
+        return [(("memory",), self.track_cache.stats()[name]), (("index",), self.track_index.stats()[name])]
+
+    def _collect_resolve_requests(self):
+        values = []
+        for node, (active, waiting) in self.scheduler.stats().items():
+            values += [((node, "active"), active), ((node, "waiting"), waiting)]
+        return values
+
+    async def _resolve(self, vc: LavalinkPlayer, query: str):
+        """Resolve a query with the local track index, then the cache, cache misses go through the node scheduler"""
+        if URL_REGEX.match(query.strip()):
+            indexed = await self.track_index.get(query.strip())
+        else:
+            indexed = await self.track_index.lookup(query)
+        if indexed is not None:
+            return [indexed.to_track()]
+
+        async def fetch(q: str):
+            return await self._fetch_tracks(vc, q)
+
+        async def schedule(q: str):
+            return await self.scheduler.submit(vc.node.label, vc.guild.id, q, fetch)
+
+        # the rate limit of the guild that started a shared request must not reject the other guilds
+        return await self.track_cache.resolve(query, schedule, own_errors=(ResolveRejected,))
+
+    async def _change_queue(self, vc: LavalinkPlayer, change):
+        """
+        Change the queue in the guild executor, after the skips and track ends already submitted
+        :param vc: the guild player
+        :param change: a function changing vc.queue, its exceptions are raised here
+        :return: the result of change
+        """
+        result = None
+
+        def run():
+            nonlocal result
+            result = change()
+            # the next track may be a different one now
+            if vc.current is not None:
+                vc.prefetch()
+
+        await self.executor.submit(vc, run)
+        return result
+
+    @staticmethod
+    async def _fetch_tracks(vc: LavalinkPlayer, query: str):
+        """Call fetch_tracks on lavalink recording its latency"""
+        start = time.perf_counter()
+        try:
+            result = await vc.fetch_tracks(query)
+        except asyncio.CancelledError:
+            metrics.fetch_latency.observe(time.perf_counter() - start, "cancelled")
+            raise
+        except Exception:
+            metrics.fetch_latency.observe(time.perf_counter() - start, "error")
+            raise
+
+        metrics.fetch_latency.observe(time.perf_counter() - start, "ok")
+        return result
+
+    async def cog_load(self):
+        self.save_snapshot.start()
+        self.reaper.start()
+
+    async def cog_unload(self):
+        self.save_snapshot.cancel()
+        self.reaper.stop()
+        self.executor.close()
+        await self.snapshots.flush()
+        await asyncio.to_thread(self.track_index.close)
+
+    @tasks.loop(seconds=30)
+    async def save_snapshot(self):
+        self.snapshots.save()
+
+    @commands.Cog.listener("on_node_ready")
+    async def restore_snapshot(self, _: mafic.Node):
+        """Resume the players saved before the last shutdown, once the first node is ready"""
+        # every node sends node_ready, also after a reconnect
+        if self.snapshots.restored:
+            return
+
+        await self.snapshots.restore()
+
+        # restored players can be paused or alone in their channel
+        for vc in self._players():
+            try:
+                self.reaper.check_channel(vc)
+                self.reaper.check_idle(vc)
+            except Exception as e:
+                logger.error(f"Could not check the restored player of guild {vc.guild.id}: {e}")
+
+    @commands.Cog.listener("on_node_ready")
+    async def wake_executor(self, _: mafic.Node):
+        """Send again the player commands that failed on a lost session"""
+        await self.executor.node_ready()
+
+    @commands.Cog.listener(name="on_track_start")
+    async def on_track_start(self, event: mafic.TrackStartEvent):
+        started = self._play_started.pop(event.player.guild.id, None)
+        if started is not None:
+            metrics.play_to_audio.observe(time.monotonic() - started)
+
+        ended = self._track_ended.pop(event.player.guild.id, None)
+        if ended is not None:
+            metrics.track_gap.observe(time.monotonic() - ended)
+
+        # the next track is ready before this one ends
+        event.player.prefetch()
+        self.reaper.playing(event.player)
+        await self.track_index.played(event.track)
+
     @commands.Cog.listener(name="on_track_end")
     @commands.Cog.listener(name="on_track_stuck")
     async def on_track_end(self, event: mafic.TrackEndEvent | mafic.TrackStuckEvent):
         player: LavalinkPlayer = event.player
 
-        track = player.queue.next()
+        # a replaced or stopped track was already handled by the command that did it
+        if isinstance(event, mafic.TrackEndEvent) and event.reason not in (mafic.EndReason.FINISHED,
+                                                                           mafic.EndReason.LOAD_FAILED):
+            return
+
+        ended = time.monotonic()
+        # a failed track may end without starting
+        load_failed = isinstance(event, mafic.TrackEndEvent) and event.reason == mafic.EndReason.LOAD_FAILED
+
+        def advance():
+            # a play or a stop was asked since this track started, so the queue already moved on
+            if player.started_track != event.track.id and not (load_failed and player.started_track is None):
+                return None
+
+            track = player.next_track()
+            if track:
+                self._track_ended[player.guild.id] = ended
+                return track
+            self.reaper.check_idle(player)
+            return None
 
-        if track:
-            return await player.play(track, replace=True)
+        await self.executor.submit(player, advance)
 
     @commands.Cog.listener("on_voice_state_update")
-    async def auto_disconnect(self, mb: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
-        """Disconnect bot if it's the only one in the voice channel"""
-        if mb.guild.voice_client is None:
+    async def on_voice_state_update(self, mb: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+        """Single handler of the voice state updates, the guilds without a player are skipped right away"""
+        # noinspection PyTypeChecker
+        vc: LavalinkPlayer = mb.guild.voice_client
+        if not isinstance(vc, LavalinkPlayer) or before.channel == after.channel:
             return
-        if before.channel == mb.guild.voice_client.channel:
-            if len(before.channel.members) == 1:
-                await mb.guild.voice_client.disconnect(force=True)
 
-    @commands.Cog.listener("on_voice_state_update")
-    async def cleanup_after_disconnect(self, mb: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
         if mb == self.bot.user:
             if isinstance(before.channel, VocalGuildChannel) and after.channel is None:
-                # noinspection PyTypeChecker
-                vc: LavalinkPlayer = mb.guild.voice_client
-                if vc is not None:
-                    vc.clean_queue()
-                    await vc.disconnect()
-                else:
-                    return
+                self.reaper.forget(mb.guild.id)
+                vc.clean_queue()
+                await vc.disconnect()
+            else:
+                # moved to another channel
+                self.reaper.check_channel(vc)
+        elif vc.channel in (before.channel, after.channel):
+            # Disconnect after a grace period if nobody is left listening
+            self.reaper.check_channel(vc)
 
     @app_commands.command(name="skip", description="Skip the current song")
     @app_commands.checks.cooldown(4, 10, key=lambda i: (i.guild_id, i.user.id))
@@ -59,13 +248,20 @@ class Music(commands.Cog):
         if vc is None:
             return await resp.send_message("❌ Not connected to a voice channel", ephemeral=True)
 
-        track = vc.queue.next()
         await resp.send_message("✅ Skipping current track", ephemeral=True)
 
-        if track:
-            return await vc.play(track, replace=True)
-        else:
-            return await vc.stop()
+        stopped = False
+
+        def advance():
+            nonlocal stopped
+            track = vc.next_track()
+            stopped = track is None
+            return track or STOP
+
+        await self.executor.submit(vc, advance)
+        # the stopped track ends with the "stopped" reason, that on_track_end leaves alone
+        if stopped:
+            self.reaper.check_idle(vc)
 
     @app_commands.command(name="play", description="Play a song from YouTube")
     @app_commands.checks.cooldown(3, 10, key=lambda i: (i.guild_id, i.user.id))
@@ -74,19 +270,15 @@ class Music(commands.Cog):
         """Play a song on a voice channel"""
         # noinspection PyTypeChecker
         resp: discord.InteractionResponse = interaction.response
+        started = time.monotonic()
 
         await resp.defer(thinking=True)
 
         if interaction.guild.voice_client is None:
             vc: LavalinkPlayer = await interaction.user.voice.channel.connect(self_deaf=True, cls=LavalinkPlayer)
-            # wait for the bot to connect, so wait for vc.is_connected() to be True
-            try:
-                async with asyncio.timeout(6):
-                    while not vc.is_connected():
-                        await asyncio.sleep(0.1)
-            except asyncio.TimeoutError:
+            if not await vc.wait_until_connected(timeout=6):
                 logger.error("Timeout in play")
-                return await resp.send_message("⚠️ Timed out on connection", ephemeral=True)
+                return await interaction.followup.send("⚠️ Timed out on connection", ephemeral=True)
         else:
             if interaction.guild.voice_client.channel != interaction.user.voice.channel:
                 return await interaction.followup.send("⚠️ Already on a different channel", ephemeral=True)
@@ -96,19 +288,26 @@ class Music(commands.Cog):
 
         try:
             async with asyncio.timeout(10):
-                tracks = await vc.fetch_tracks(query)
+                tracks = await self._resolve(vc, query)
         except asyncio.TimeoutError:
             logger.error("Timeout in fetch_tracks")
+            metrics.fetch_timeouts.inc()
             return await interaction.followup.send("⚠️ Timed out on track fetch", ephemeral=True)
+        except ResolveRejected as e:
+            logger.warning(f"Track resolution rejected in guild {interaction.guild_id}: {e.reason}")
+            return await interaction.followup.send("⚠️ Too many requests, try again in a few seconds", ephemeral=True)
         except Exception as e:
             logger.error(f"Error in fetch_tracks: {e}")
             return await interaction.followup.send("⚠️ An error occurred", ephemeral=True)
 
         if tracks is None or (isinstance(tracks, list) and len(tracks) == 0):
             return await interaction.followup.send("⚠️ No song found", ephemeral=True)
+        elif isinstance(tracks, list) and vc.queue.has(tracks[0].identifier):
+            return await interaction.followup.send("⚠️ This song is already in the queue", ephemeral=True)
         else:
             try:
-                embed = vc.queue.add(tracks)
+                # after the skips and track ends already submitted, so they don't pick the added track
+                embed = await self._change_queue(vc, lambda: vc.queue.add(tracks, requester=interaction.user.id))
             except Exception as e:
                 logger.error(f"Error in queue.add: {e}")
                 return await interaction.followup.send("⚠️ An error occurred", ephemeral=True)
@@ -116,13 +315,39 @@ class Music(commands.Cog):
             if embed is None:
                 return await interaction.followup.send("⚠️ Could not add the song to the queue", ephemeral=True)
             await interaction.followup.send("✅ Added to the queue", embed=embed)
+            # Only the tracks added to the queue are indexed, not every search result
+            await self.track_index.record(tracks.tracks if isinstance(tracks, mafic.Playlist) else tracks[:1])
+
+        def start():
+            # a track asked by an operation before this one is not playing yet, a stop asked for an empty queue is
+            # replaced by the added track
+            if self.executor.stopping(vc.guild.id):
+                return vc.queue.next()
+            if (vc.current is None and not self.executor.pending(vc.guild.id)) or vc.paused is True:
+                return vc.queue.next()
+            vc.prefetch()
+            return None
 
-        if vc.current is None or (vc.current is not None and vc.paused is True):
-            try:
-                await vc.play(vc.queue.next(), replace=True)
-            except Exception as e:
-                logger.error(f"Error in play: {e}")
-                return await interaction.followup.send("⚠️ An error occurred", ephemeral=True)
+        try:
+            self._play_started[interaction.guild_id] = started
+            if not await self.executor.submit(vc, start):
+                self._play_started.pop(interaction.guild_id, None)
+        except Exception as e:
+            self._play_started.pop(interaction.guild_id, None)
+            logger.error(f"Error in play: {e}")
+            return await interaction.followup.send("⚠️ An error occurred", ephemeral=True)
+
+    @play.autocomplete("query")
+    async def play_autocomplete(self, _: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        """Suggest the indexed tracks matching the text typed so far"""
+        if len(current.strip()) < 2 or URL_REGEX.match(current.strip()):
+            return []
+
+        return [
+            app_commands.Choice(name=f"{track.title} - {track.author}"[:100], value=track.uri)
+            for track in await self.track_index.search(current, limit=25)
+            if len(track.uri) <= 100
+        ]
 
     @app_commands.command(name="repeat", description="Repeat the same song")
     async def repeat(self, interaction: discord.Interaction):
@@ -134,7 +359,7 @@ class Music(commands.Cog):
         if vc is None:
             return await resp.send_message("❌ Not connected to a voice channel", ephemeral=True)
 
-        status = vc.queue.toggle_repeat()
+        status = await self._change_queue(vc, vc.queue.toggle_repeat)
 
         if status:
             await resp.send_message("🔂 Enabled repeat")
@@ -151,7 +376,7 @@ class Music(commands.Cog):
         if vc is None:
             return await resp.send_message("❌ Not connected to a voice channel", ephemeral=True)
 
-        status = vc.queue.toggle_loop()
+        status = await self._change_queue(vc, vc.queue.toggle_loop)
 
         if status:
             await resp.send_message("🔁 Enabled loop")
@@ -168,13 +393,66 @@ class Music(commands.Cog):
         if vc is None:
             return await resp.send_message("❌ Not connected to a voice channel", ephemeral=True)
 
-        status = vc.queue.toggle_shuffle()
+        status = await self._change_queue(vc, vc.queue.toggle_shuffle)
 
         if status:
             await resp.send_message("🔀 Enabled shuffle")
         else:
             await resp.send_message("➡️ Disabled shuffle")
 
+    @app_commands.command(name="queue", description="Show the queue")
+    @app_commands.describe(page="The page to show")
+    async def queue(self, interaction: discord.Interaction, page: app_commands.Range[int, 1] = 1):
+        # noinspection PyTypeChecker
+        resp: discord.InteractionResponse = interaction.response
+        # noinspection PyTypeChecker
+        vc: LavalinkPlayer = interaction.guild.voice_client
+
+        if vc is None:
+            return await resp.send_message("❌ Not connected to a voice channel", ephemeral=True)
+
+        view = QueuePages(vc, page=page - 1)
+        await resp.send_message(embed=view.render(), view=view, ephemeral=True)
+
+    @app_commands.command(name="remove", description="Remove a song from the queue")
+    @app_commands.describe(position="The position of the song in the queue")
+    async def remove(self, interaction: discord.Interaction, position: app_commands.Range[int, 1]):
+        # noinspection PyTypeChecker
+        resp: discord.InteractionResponse = interaction.response
+        # noinspection PyTypeChecker
+        vc: LavalinkPlayer = interaction.guild.voice_client
+
+        if vc is None:
+            return await resp.send_message("❌ Not connected to a voice channel", ephemeral=True)
+
+        try:
+            entry = await self._change_queue(vc, lambda: vc.queue.remove(position - 1))
+        except IndexError:
+            return await resp.send_message(f"❌ The queue has {len(vc.queue)} song(s)", ephemeral=True)
+
+        await resp.send_message(f"🗑️ Removed {discord.utils.escape_markdown(entry.title or 'the song')}",
+                                suppress_embeds=True)
+
+    @app_commands.command(name="move", description="Move a song to a different position of the queue")
+    @app_commands.describe(source="The position of the song", destination="The new position of the song")
+    async def move(self, interaction: discord.Interaction, source: app_commands.Range[int, 1],
+                   destination: app_commands.Range[int, 1]):
+        # noinspection PyTypeChecker
+        resp: discord.InteractionResponse = interaction.response
+        # noinspection PyTypeChecker
+        vc: LavalinkPlayer = interaction.guild.voice_client
+
+        if vc is None:
+            return await resp.send_message("❌ Not connected to a voice channel", ephemeral=True)
+
+        try:
+            entry = await self._change_queue(vc, lambda: vc.queue.move(source - 1, destination - 1))
+        except IndexError:
+            return await resp.send_message(f"❌ The queue has {len(vc.queue)} song(s)", ephemeral=True)
+
+        await resp.send_message(f"↕️ Moved {discord.utils.escape_markdown(entry.title or 'the song')} to position "
+                                f"{destination}", suppress_embeds=True)
+
     @app_commands.command(name="join", description="Join a voice channel")
     @app_commands.describe(channel="A different channel that you want the bot to join")
     @app_commands.checks.cooldown(3, 10, key=lambda i: (i.guild_id, i.user.id))
@@ -209,9 +487,15 @@ class Music(commands.Cog):
         else:
             try:
                 await resp.send_message(f"✅ Connecting to {channel.mention}", suppress_embeds=True)
-                await channel.connect(self_deaf=True, cls=LavalinkPlayer, timeout=10)
+                vc: LavalinkPlayer = await channel.connect(self_deaf=True, cls=LavalinkPlayer, timeout=10)
             except (discord.ClientException, asyncio.TimeoutError):
-                return await resp.send_message("❌ Could not connect to your voice channel", ephemeral=True)
+                return await interaction.followup.send("❌ Could not connect to your voice channel", ephemeral=True)
+
+            if not await vc.wait_until_connected(timeout=6):
+                logger.error("Timeout in join")
+                return await interaction.followup.send("⚠️ Timed out on connection", ephemeral=True)
+
+            self.reaper.check_idle(vc)
 
     @app_commands.command(name="disconnect", description="Disconnect from the current channel")
     async def disconnect(self, interaction: discord.Interaction):
@@ -220,6 +504,7 @@ class Music(commands.Cog):
         voice_client: LavalinkPlayer | None = interaction.guild.voice_client
 
         if voice_client:
+            self.reaper.forget(interaction.guild_id)
             await voice_client.disconnect()
             return await resp.send_message(f"✅ Disconnected", suppress_embeds=True)
         else:
@@ -232,7 +517,7 @@ class Music(commands.Cog):
         voice_client: LavalinkPlayer | None = interaction.guild.voice_client
 
         if voice_client:
-            n = voice_client.queue.clean()
+            n = await self._change_queue(voice_client, voice_client.queue.clean)
             return await resp.send_message(f"✅ Removed {n} track(s)", suppress_embeds=True)
         else:
             return await resp.send_message("❌ Not connected to a voice channel", ephemeral=True)
@@ -240,5 +525,6 @@ class Music(commands.Cog):
 
 async def setup(bot: commands.Bot) -> None:
     logger.debug("Loading music cog")
+    load_limits()
     await bot.add_cog(Music(bot))
     logger.info("Music cog loaded")
@@ -0,0 +1,168 @@
+import copy
+from collections import OrderedDict
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+import discord
+from mafic import Track, Playlist
+
+if TYPE_CHECKING:
+    from .queue import Queue, QueueEntry
+
+__all__ = [
+    "EmbedCache",
+    "playlist_embed",
+    "track_embed",
+    "queue_embed",
+    "queue_pages",
+    "parse_seconds"
+]
+
+
+SOURCE_COLORS: dict[str, discord.Color] = {
+    "twitch": discord.Color.purple(),
+    "youtube": discord.Color.red(),
+    "soundcloud": discord.Color.orange(),
+}
+
+
+def source_color(source: str, seed: str | None = None) -> discord.Color:
+    color = SOURCE_COLORS.get(source)
+    if color is None:
+        color = discord.Color.random(seed=seed)
+    return color
+
+
+class EmbedCache:
+    """
+    Bounded LRU of rendered embeds
+
+    The cached embeds are never handed out, callers get a copy they can freely add fields to.
+    """
+
+    def __init__(self, max_size: int = 512):
+        self.max_size = max_size
+        self._items: OrderedDict[tuple, discord.Embed] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @staticmethod
+    def _copy(embed: discord.Embed) -> discord.Embed:
+        # Embed.copy round-trips through to_dict, copying the fields list is enough
+        new = copy.copy(embed)
+        new._fields = [field.copy() for field in getattr(embed, "_fields", [])]
+        return new
+
+    def get(self, key: tuple) -> discord.Embed | None:
+        embed = self._items.get(key)
+        if embed is None:
+            return None
+
+        self._items.move_to_end(key)
+        return self._copy(embed)
+
+    def put(self, key: tuple, embed: discord.Embed) -> discord.Embed:
+        self._items[key] = embed
+        self._items.move_to_end(key)
+        if len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+        return self._copy(embed)
+
+    def clear(self):
+        self._items.clear()
+
+
+_cache = EmbedCache()
+
+
+def playlist_embed(result: Playlist) -> discord.Embed:
+    first = result.tracks[0]
+    key = ("playlist", result.name, first.source, first.identifier)
+
+    embed = _cache.get(key)
+    if embed is not None:
+        return embed
+
+    embed = discord.Embed(color=source_color(first.source, result.name))
+
+    embed.title = result.name
+    embed.description = "Playlist"
+    embed.set_thumbnail(url=first.artwork_url)
+
+    return _cache.put(key, embed)
+
+
+def track_embed(result: Track) -> discord.Embed:
+    key = ("track", result.source, result.identifier)
+
+    embed = _cache.get(key)
+    if embed is not None:
+        return embed
+
+    embed = discord.Embed(color=source_color(result.source, result.identifier))
+
+    embed.title = result.title
+    embed.url = result.uri
+    embed.set_author(name=result.author)
+    embed.set_thumbnail(url=result.artwork_url)
+
+    if not result.stream:
+        embed.add_field(name="Video duration", value=parse_seconds(result.length // 1000))
+    else:
+        embed.add_field(name="Live on", value=result.source)
+
+    return _cache.put(key, embed)
+
+
+def queue_embed(queue: "Queue", page: int, size: int = 10) -> discord.Embed:
+    """
+    Render a page of a queue, only the entries of the page are read
+    :param queue: the queue
+    :param page: the page number from 0, it must exist
+    :param size: the number of entries in a page
+    :return: an Embed object
+    """
+    embed = discord.Embed(title="Queue", color=discord.Color.blurple())
+
+    if queue.current is not None:
+        embed.add_field(name="Now playing", value=_queue_line(queue.current), inline=False)
+
+    first = page * size
+    entries = queue.entries(first, first + size)
+    if entries:
+        embed.description = "\n".join(
+            f"`{position}.` {_queue_line(entry)}" for position, entry in enumerate(entries, start=first + 1)
+        )
+    else:
+        embed.description = "The queue is empty"
+
+    footer = [f"Page {page + 1}/{queue_pages(queue, size)}", f"{len(queue)} track(s)",
+              parse_seconds(queue.duration // 1000)]
+    footer += [mode for mode, enabled in (("🔂 repeat", queue.repeat), ("🔁 loop", queue.loop),
+                                          ("🔀 shuffle", queue.shuffle)) if enabled]
+    embed.set_footer(text=" · ".join(footer))
+
+    return embed
+
+
+def queue_pages(queue: "Queue", size: int = 10) -> int:
+    return max(1, -(-len(queue) // size))
+
+
+def _queue_line(entry: "QueueEntry") -> str:
+    title = discord.utils.escape_markdown(entry.title[:80]) if entry.title else "Unknown track"
+    return f"{title} `{parse_seconds(entry.length // 1000)}`"
+
+
+@lru_cache(maxsize=4096)
+def parse_seconds(seconds: int) -> str:
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+
+    result = "%(minutes)02d:%(seconds)02d" % {"minutes": minutes, "seconds": seconds}
+
+    if hours != 0:
+        result = f"{hours}:" + result
+    return result
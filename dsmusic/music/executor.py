@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+import mafic
+
+from ..metrics import metrics
+from .player import LavalinkPlayer
+from .queue import QueueEntry
+
+__all__ = [
+    "STOP",
+    "GuildExecutor"
+]
+
+
+logger = logging.getLogger('dsbot.music.executor')
+
+# Returned by an operation to stop the player
+STOP = object()
+# started_track of a player while its command waits to be sent, so the end of the previous track is ignored
+_ASKED = object()
+
+Action = mafic.Track | QueueEntry | object | None
+Operation = Callable[[], Action | Awaitable[Action]]
+
+
+class _Actor:
+    __slots__ = ("ops", "pending", "waiters", "last_sent", "wakeup", "task")
+
+    def __init__(self):
+        self.ops: deque[tuple[LavalinkPlayer, Operation, asyncio.Future]] = deque()
+        # (player, track or STOP) not sent yet, and the futures of the operations that asked for it
+        self.pending: tuple[LavalinkPlayer, Action] | None = None
+        self.waiters: list[asyncio.Future] = []
+        self.last_sent = 0.0
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+
+class GuildExecutor:
+    """
+    Serialize the operations that decide what a guild player plays
+
+    The operations of a guild run one at a time in submission order, each guild has its own worker so guilds never
+    wait on each other. An operation can change the queue and returns the track to play, STOP or None; the player
+    command is sent by the worker. Commands asked by operations run back to back, or less than `window` seconds
+    after the previous command, are coalesced: only the last one reaches lavalink.
+    """
+
+    def __init__(self, window: float = 0.2, session_timeout: float = 15):
+        self.window = window
+        # how long a command waits for a lost lavalink session to be replaced before it is sent again
+        self.session_timeout = session_timeout
+        self._actors: dict[int, _Actor] = {}
+        # notified when a node is ready, with its players synced
+        self._node_ready = asyncio.Condition()
+
+    def __len__(self) -> int:
+        return len(self._actors)
+
+    def pending(self, guild_id: int) -> bool:
+        """
+        Check if a player command was asked and not sent yet
+        :param guild_id: the guild id
+        :return: True if a command is waiting
+        """
+        actor = self._actors.get(guild_id)
+        return actor is not None and actor.pending is not None
+
+    def stopping(self, guild_id: int) -> bool:
+        """
+        Check if the command waiting to be sent stops the player
+        :param guild_id: the guild id
+        :return: True if a stop is waiting
+        """
+        actor = self._actors.get(guild_id)
+        return actor is not None and actor.pending is not None and actor.pending[1] is STOP
+
+    async def submit(self, vc: LavalinkPlayer, operation: Operation) -> bool:
+        """
+        Run an operation after the ones already submitted for the guild
+        :param vc: the guild player
+        :param operation: a function returning the track to play, STOP or None, it may be a coroutine function
+        :return: if a player command was sent for it, errors of the command are raised
+        """
+        actor = self._actors.get(vc.guild.id)
+        if actor is None:
+            actor = self._actors[vc.guild.id] = _Actor()
+
+        future = asyncio.get_running_loop().create_future()
+        actor.ops.append((vc, operation, future))
+        actor.wakeup.set()
+
+        if actor.task is None:
+            actor.task = asyncio.create_task(self._work(vc.guild.id, actor))
+        return await future
+
+    async def node_ready(self):
+        """Wake the commands waiting for a lost session to be replaced, call it on every node_ready"""
+        async with self._node_ready:
+            self._node_ready.notify_all()
+
+    def close(self):
+        """Cancel the workers, dropping the operations not run yet"""
+        for actor in self._actors.values():
+            if actor.task is not None:
+                actor.task.cancel()
+            for _, _, future in actor.ops:
+                future.cancel()
+            for future in actor.waiters:
+                future.cancel()
+        self._actors.clear()
+
+    async def _work(self, guild_id: int, actor: _Actor):
+        try:
+            while True:
+                if actor.ops:
+                    vc, operation, future = actor.ops.popleft()
+                    try:
+                        action = operation()
+                        if asyncio.iscoroutine(action):
+                            action = await action
+                    except Exception as e:
+                        if not future.done():
+                            future.set_exception(e)
+                        continue
+
+                    if action is None:
+                        if not future.done():
+                            future.set_result(False)
+                        continue
+
+                    # the next operations must not advance the queue again for the track playing until now
+                    vc.started_track = _ASKED
+                    if actor.pending is not None:
+                        metrics.player_commands.inc("coalesced")
+                    actor.pending = (vc, action)
+                    actor.waiters.append(future)
+                    continue
+
+                if actor.pending is None:
+                    break
+
+                # a burst of commands: wait for the window to end, the next operations can replace the command
+                delay = actor.last_sent + self.window - time.monotonic()
+                if delay > 0:
+                    actor.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(actor.wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    else:
+                        continue
+
+                await self._send(actor)
+        finally:
+            if self._actors.get(guild_id) is actor:
+                del self._actors[guild_id]
+
+    @staticmethod
+    async def _command(vc: LavalinkPlayer, action: Action):
+        # the end event of the track playing until now is not for the new one
+        vc.started_track = None
+        if action is STOP:
+            await vc.stop()
+        else:
+            await vc.play(action, replace=True)
+
+    async def _wait_for_session(self, vc: LavalinkPlayer, lost: str | None) -> bool:
+        """
+        Wait for the node of a player to be ready on a new session, with the player replayed on it
+        :param vc: the guild player
+        :param lost: the id of the session that lavalink does not know anymore
+        :return: False if it did not happen within the session timeout
+        """
+        try:
+            async with asyncio.timeout(self.session_timeout), self._node_ready:
+                # any node can be the ready one, the player may also be moved to a different node meanwhile
+                await self._node_ready.wait_for(lambda: vc.node.session_id != lost and vc.node.available)
+        except asyncio.TimeoutError:
+            return False
+        return await vc.wait_until_connected(timeout=self.session_timeout)
+
+    async def _send(self, actor: _Actor):
+        (vc, action), actor.pending = actor.pending, None
+        waiters, actor.waiters = actor.waiters, []
+        actor.last_sent = time.monotonic()
+
+        session = vc.node.session_id
+        try:
+            try:
+                await self._command(vc, action)
+            except mafic.HTTPNotFound:
+                # lavalink lost the session and the player with it, send the command again once it is replayed
+                logger.warning(f"Session of player {vc.guild.id} lost, waiting for the node to send the command again")
+                if not await self._wait_for_session(vc, session):
+                    raise
+                metrics.player_commands.inc("retried")
+                await self._command(vc, action)
+        except Exception as e:
+            metrics.player_commands.inc("error")
+            for future in waiters:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        metrics.player_commands.inc("sent")
+        for future in waiters:
+            if not future.done():
+                future.set_result(True)
@@ -0,0 +1,283 @@
+import asyncio
+import logging
+import os
+import re
+import sqlite3
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
+
+from mafic import Track
+
+__all__ = [
+    "IndexedTrack",
+    "TrackIndex"
+]
+
+
+logger = logging.getLogger('dsbot.music.index')
+
+TOKEN_REGEX = re.compile(r"\w+")
+
+# share of the title words a /play query must contain to be answered from the index
+MIN_TITLE_COVERAGE = 0.75
+# candidates checked for the coverage, the best ranked is often a live or remastered version
+LOOKUP_CANDIDATES = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    uri TEXT NOT NULL UNIQUE,
+    encoded TEXT NOT NULL,
+    identifier TEXT NOT NULL,
+    source TEXT NOT NULL,
+    title TEXT NOT NULL,
+    author TEXT NOT NULL,
+    length INTEGER NOT NULL,
+    plays INTEGER NOT NULL DEFAULT 0,
+    last_played REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tracks_eviction ON tracks (plays, last_played);
+CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+    title, author, content='tracks', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS tracks_ai AFTER INSERT ON tracks BEGIN
+    INSERT INTO tracks_fts (rowid, title, author) VALUES (new.id, new.title, new.author);
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_ad AFTER DELETE ON tracks BEGIN
+    INSERT INTO tracks_fts (tracks_fts, rowid, title, author) VALUES ('delete', old.id, old.title, old.author);
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_au AFTER UPDATE OF title, author ON tracks BEGIN
+    INSERT INTO tracks_fts (tracks_fts, rowid, title, author) VALUES ('delete', old.id, old.title, old.author);
+    INSERT INTO tracks_fts (rowid, title, author) VALUES (new.id, new.title, new.author);
+END;
+"""
+
+# bm25 is negative, lower is better: popular tracks get up to twice the relevance
+SEARCH = """
+SELECT t.encoded, t.identifier, t.source, t.title, t.author, t.uri, t.length, t.plays
+FROM tracks_fts JOIN tracks t ON t.id = tracks_fts.rowid
+WHERE tracks_fts MATCH ?
+ORDER BY bm25(tracks_fts, 2.0, 1.0) * (1.0 + t.plays * 1.0 / (t.plays + 5)) LIMIT ?
+"""
+
+
+def _match_expression(query: str, prefix: bool) -> str | None:
+    """
+    Build a FTS5 query matching all the words of a text query
+    :param query: the text typed by the user
+    :param prefix: if the last word can be incomplete
+    :return: the MATCH expression, None if the query has no words
+    """
+    tokens = TOKEN_REGEX.findall(query.casefold())
+    if not tokens:
+        return None
+
+    # quoted, so words like AND or NEAR are not operators
+    terms = [f'"{token}"' for token in tokens]
+    if prefix:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+def _words(text: str) -> set[str]:
+    """
+    Split a text in words as the FTS tokenizer does, case and diacritics insensitive
+    :param text: the text to split
+    :return: the distinct words
+    """
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return set(TOKEN_REGEX.findall("".join(c for c in decomposed if not unicodedata.combining(c))))
+
+
+class IndexedTrack:
+    __slots__ = ("encoded", "identifier", "source", "title", "author", "uri", "length", "plays")
+
+    def __init__(self, encoded: str, identifier: str, source: str, title: str, author: str, uri: str, length: int,
+                 plays: int):
+        self.encoded = encoded
+        self.identifier = identifier
+        self.source = source
+        self.title = title
+        self.author = author
+        self.uri = uri
+        self.length = length
+        self.plays = plays
+
+    def to_track(self) -> Track:
+        """
+        Build the mafic Track, with the fields used by the queue and the embeds
+        :return: a Track object
+        """
+        return Track(
+            track_id=self.encoded,
+            identifier=self.identifier,
+            seekable=True,
+            author=self.author,
+            length=self.length,
+            stream=False,
+            title=self.title,
+            uri=self.uri,
+            artwork_url=None,
+            isrc=None,
+            source=self.source,
+        )
+
+
+class TrackIndex:
+    """
+    Persistent full-text index of the tracks played on the bot
+
+    Text queries and autocomplete suggestions are answered from it, ranked by relevance and number of plays, so
+    songs already played do not need a new search on lavalink. When the index holds more than `max_tracks` tracks
+    the least played ones are evicted. SQLite runs in a dedicated thread.
+    """
+
+    def __init__(self, path: str = "data/tracks.db", max_tracks: int = 50_000):
+        self.path = path
+        self.max_tracks = max_tracks
+
+        self._db: sqlite3.Connection | None = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="track-index")
+        self._count = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA busy_timeout=2000")
+            db.executescript(SCHEMA)
+            self._count = db.execute("SELECT count(*) FROM tracks").fetchone()[0]
+            self._db = db
+        return self._db
+
+    async def _run(self, func, *args):
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        except sqlite3.Error as e:
+            logger.error(f"Track index error: {e}")
+            return None
+
+    def close(self):
+        """Close the database, waiting for the pending operations"""
+        def _close():
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+        self._executor.submit(_close)
+        self._executor.shutdown(wait=True)
+
+    # Writes
+
+    def _record(self, rows: list[tuple]):
+        db = self._connect()
+        with db:
+            db.executemany(
+                "INSERT INTO tracks (uri, encoded, identifier, source, title, author, length, last_played) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (uri) DO UPDATE SET encoded = excluded.encoded, title = excluded.title, "
+                "author = excluded.author, length = excluded.length",
+                rows
+            )
+            self._count = db.execute("SELECT count(*) FROM tracks").fetchone()[0]
+            if self._count > self.max_tracks:
+                # evict a bit more than needed, so this does not run on every insert
+                excess = self._count - int(self.max_tracks * 0.9)
+                db.execute(
+                    "DELETE FROM tracks WHERE id IN (SELECT id FROM tracks ORDER BY plays, last_played LIMIT ?)",
+                    (excess,)
+                )
+                self._count -= excess
+                logger.info(f"Evicted {excess} rarely played tracks from the index")
+
+    async def record(self, tracks: Iterable[Track]):
+        """
+        Add or update resolved tracks, streams and tracks without an URI are skipped
+        :param tracks: the tracks to add
+        """
+        now = time.time()
+        rows = [
+            (t.uri, t.id, t.identifier, t.source, t.title, t.author, t.length, now)
+            for t in tracks if t.uri and not t.stream
+        ]
+        if rows:
+            await self._run(self._record, rows)
+
+    def _played(self, uri: str):
+        db = self._connect()
+        with db:
+            db.execute("UPDATE tracks SET plays = plays + 1, last_played = ? WHERE uri = ?", (time.time(), uri))
+
+    async def played(self, track: Track):
+        """
+        Count a play of a track
+        :param track: the track that started
+        """
+        if track.uri:
+            await self._run(self._played, track.uri)
+
+    # Reads
+
+    def _search(self, expression: str, limit: int) -> list[IndexedTrack]:
+        return [IndexedTrack(*row) for row in self._connect().execute(SEARCH, (expression, limit))]
+
+    async def search(self, query: str, limit: int = 25, prefix: bool = True) -> list[IndexedTrack]:
+        """
+        Find the indexed tracks whose title or author contain all the words of the query
+        :param query: the text to search
+        :param limit: the maximum number of results
+        :param prefix: if the last word can be incomplete, as while typing
+        :return: the tracks, best match first
+        """
+        expression = _match_expression(query, prefix)
+        if expression is None:
+            return []
+        return await self._run(self._search, expression, limit) or []
+
+    async def lookup(self, query: str) -> IndexedTrack | None:
+        """
+        Resolve a text query of at least two words with the best indexed match covering most of its title
+        :param query: the text query of /play
+        :return: the best track, None on a miss
+        """
+        # a single word matches too many titles to be trusted, those queries are left to lavalink
+        words = _words(query)
+        results = []
+        if len(words) >= 2:
+            results = await self.search(query, limit=LOOKUP_CANDIDATES, prefix=False)
+
+        # every query word is in the title or author, but the title may have many more: "bohemian rhapsody" must
+        # not be answered with "Bohemian Rhapsody (Live Aid 1985)"
+        for track in results:
+            title = _words(track.title)
+            if title and len(title & words) >= MIN_TITLE_COVERAGE * len(title):
+                self.hits += 1
+                return track
+
+        self.misses += 1
+        return None
+
+    def _get(self, uri: str) -> IndexedTrack | None:
+        row = self._connect().execute(
+            "SELECT encoded, identifier, source, title, author, uri, length, plays FROM tracks WHERE uri = ?", (uri,)
+        ).fetchone()
+        return IndexedTrack(*row) if row is not None else None
+
+    async def get(self, uri: str) -> IndexedTrack | None:
+        """
+        Get an indexed track by URI
+        :param uri: the track URI
+        :return: the track, None if it is not indexed
+        """
+        return await self._run(self._get, uri)
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "tracks": self._count}
@@ -0,0 +1,86 @@
+import logging
+import os
+
+import orjson
+
+__all__ = [
+    "QueueLimits",
+    "load_limits",
+    "get_limits"
+]
+
+
+logger = logging.getLogger('dsbot.music.limits')
+
+
+class QueueLimits:
+    """Limits applied when adding tracks to a queue, lengths are in milliseconds"""
+    __slots__ = ("max_track_length", "max_total_length", "max_tracks")
+
+    def __init__(self, max_track_length: int = 3_600_000, max_total_length: int = 8_200_000, max_tracks: int = 48):
+        self.max_track_length = max_track_length  # max 1 hour
+        self.max_total_length = max_total_length  # total max ~136 minutes
+        self.max_tracks = max_tracks
+
+    @classmethod
+    def from_dict(cls, data: dict, base: "QueueLimits | None" = None) -> "QueueLimits":
+        """
+        Build the limits from a config entry, missing keys are taken from base
+        :param data: a dict with the limits in seconds
+        :param base: the limits used for the missing keys
+        :return: a QueueLimits object
+        """
+        base = base or cls()
+        return cls(
+            max_track_length=int(data["max_track_length"] * 1000) if "max_track_length" in data
+            else base.max_track_length,
+            max_total_length=int(data["max_total_length"] * 1000) if "max_total_length" in data
+            else base.max_total_length,
+            max_tracks=int(data.get("max_tracks", base.max_tracks)),
+        )
+
+    def __repr__(self) -> str:
+        return (f"<QueueLimits max_track_length={self.max_track_length} max_total_length={self.max_total_length} "
+                f"max_tracks={self.max_tracks}>")
+
+
+_default = QueueLimits()
+_guilds: dict[int, QueueLimits] = {}
+
+
+def load_limits(path: str = "config/limits.json"):
+    """
+    Load the per guild limits
+
+    The file contains an optional "default" entry and one entry for each guild id, every entry can set
+    max_track_length and max_total_length in seconds and max_tracks.
+    :param path: the config file
+    """
+    global _default
+
+    if not (os.path.exists(path) and os.path.isfile(path)):
+        return
+
+    try:
+        with open(path, "rb") as f:
+            data = orjson.loads(f.read())
+
+        default = QueueLimits.from_dict(data.get("default", {}))
+        guilds = {int(k): QueueLimits.from_dict(v, default) for k, v in data.items() if k != "default"}
+    except (orjson.JSONDecodeError, ValueError, TypeError, KeyError, AttributeError) as e:
+        logger.error(f"Invalid limits config {path}: {e}")
+        return
+
+    _default = default
+    _guilds.clear()
+    _guilds.update(guilds)
+    logger.info(f"Loaded queue limits for {len(_guilds)} guild(s)")
+
+
+def get_limits(guild_id: int | None) -> QueueLimits:
+    """
+    Get the limits of a guild
+    :param guild_id: the id of the guild
+    :return: the guild limits or the default ones
+    """
+    return _guilds.get(guild_id, _default)
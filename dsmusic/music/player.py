@@ -1,10 +1,17 @@
+import asyncio
+import logging
+import time
 from typing import Generic
 
 import mafic
 # noinspection PyProtectedMember
 from discord._types import ClientT
 
-from .queue import Queue
+from ..metrics import metrics
+from .limits import get_limits
+from .queue import Queue, QueueEntry
+
+logger = logging.getLogger('dsbot.music.player')
 
 
 class LavalinkPlayer(mafic.Player, Generic[ClientT]):
@@ -13,12 +20,138 @@ class LavalinkPlayer(mafic.Player, Generic[ClientT]):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self.queue = Queue()
+        self.queue = Queue(limits=get_limits(self.guild.id))
+
+        # Set when lavalink reports the voice connection as established
+        self._connection_ready = asyncio.Event()
+        self._connect_started: float | None = None
+
+        # encoded track of the last TrackStartEvent, replaced when a new play or stop is asked and cleared when it
+        # is sent, see GuildExecutor
+        self.started_track: str | object | None = None
+
+        # (queue version, entry, decoded track) of the next track, prepared while the current one plays
+        self._prefetched: tuple[int, QueueEntry, mafic.Track] | None = None
+        self._prefetch_task: asyncio.Task | None = None
 
     def clean_queue(self):
         """
         Delete queue
         :return: None
         """
-        del self.queue
-        self.queue = Queue()
+        self.queue.clean()
+        self.cancel_prefetch()
+
+    async def connect(self, *, timeout: float, reconnect: bool, self_mute: bool = False, self_deaf: bool = False):
+        self._connect_started = time.monotonic()
+        await super().connect(timeout=timeout, reconnect=reconnect, self_mute=self_mute, self_deaf=self_deaf)
+
+    def update_state(self, state) -> None:
+        super().update_state(state)
+
+        if self._connected and not self._connection_ready.is_set():
+            self._connection_ready.set()
+            if self._connect_started is not None:
+                metrics.voice_connect.observe(time.monotonic() - self._connect_started)
+                self._connect_started = None
+        elif not self._connected and self._connection_ready.is_set():
+            self._connection_ready.clear()
+
+    def cleanup(self) -> None:
+        self._connection_ready.clear()
+        self.cancel_prefetch()
+        super().cleanup()
+
+    def dispatch_event(self, data) -> None:
+        current = self._current
+        super().dispatch_event(data)
+
+        if data["type"] == "TrackStartEvent":
+            self.started_track = data["track"]["encoded"]
+        elif data["type"] == "TrackEndEvent" and data["reason"] == "replaced":
+            # mafic checks the v3 "REPLACED" reason, the track that replaced this one is still playing
+            self._current = current
+
+    async def wait_until_connected(self, timeout: float | None = None) -> bool:
+        """
+        Wait until the voice server/state handshake is completed and lavalink is connected
+        :param timeout: the maximum time to wait, in seconds
+        :return: if the player is connected
+        """
+        if self._connected:
+            return True
+
+        try:
+            async with asyncio.timeout(timeout):
+                await self._connection_ready.wait()
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def play(self, track: mafic.Track | QueueEntry | str, /, **kwargs) -> None:
+        """
+        Play a track, accepting also the compact entries stored in the queue
+        :param track: the track to play
+        :return: None
+        """
+        if isinstance(track, QueueEntry):
+            track = track.to_track()
+
+        return await super().play(track, **kwargs)
+
+    def prefetch(self):
+        """Prepare the next track in the background, replacing a previous prefetch"""
+        self.cancel_prefetch()
+        if self.queue.peek() is not None:
+            self._prefetch_task = asyncio.create_task(self._prefetch())
+
+    def cancel_prefetch(self):
+        if self._prefetch_task is not None:
+            self._prefetch_task.cancel()
+            self._prefetch_task = None
+        self._prefetched = None
+
+    async def _prefetch(self):
+        while (entry := self.queue.peek()) is not None:
+            version = self.queue.version
+
+            try:
+                track = await self.node.decode_track(entry.encoded)
+            except (mafic.HTTPException, mafic.TrackLoadException) as e:
+                if self.queue.version != version:
+                    continue
+
+                # the track would fail to load on lavalink, drop it now instead of when it should start
+                logger.warning(f"Dropping an invalid track from the queue of {self.guild.id}: {e}")
+                if entry is self.queue.current or not self.queue.discard(entry):
+                    return
+                metrics.prefetch.inc("invalid")
+                continue
+            except Exception as e:
+                logger.error(f"Error prefetching the next track of {self.guild.id}: {e}")
+                metrics.prefetch.inc("error")
+                return
+
+            # the queue could have changed while decoding
+            if self.queue.version == version:
+                self._prefetched = (version, entry, track)
+                return
+
+    def next_track(self) -> mafic.Track | QueueEntry | None:
+        """
+        Advance the queue, returning the prefetched track when the queue did not change since it was prepared
+        :return: the track to play, None if the queue is over
+        """
+        prefetched, self._prefetched = self._prefetched, None
+        version = self.queue.version
+
+        entry = self.queue.next()
+        if entry is None:
+            return None
+
+        if prefetched is not None and prefetched[0] == version and prefetched[1] is entry:
+            metrics.prefetch.inc("hit")
+            return prefetched[2]
+
+        metrics.prefetch.inc("miss")
+        return entry
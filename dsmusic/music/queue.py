@@ -1,79 +1,154 @@
 import logging
-from random import randint
+from bisect import bisect_left
+from collections import deque
+from itertools import accumulate, count
+from random import randrange, shuffle
 from typing import Optional
 
 import discord
 from mafic import Track, Playlist
 
+from .embeds import playlist_embed, track_embed
+from .limits import QueueLimits
+
 __all__ = [
-    "Queue"
+    "Queue",
+    "QueueEntry"
 ]
 
 
 logger = logging.getLogger('dsbot.music.queue')
 
 
-def playlist_embed(result: Playlist) -> discord.Embed:
-    if result.tracks[0].source == "youtube":
-        color = discord.Color.red()
-    elif result.tracks[0].source == "soundcloud":
-        color = discord.Color.orange()
-    else:
-        color = discord.Color.random()
-
-    embed = discord.Embed(color=color)
-
-    embed.title = result.name
-    embed.description = "Playlist"
-    embed.set_thumbnail(url=result.tracks[0].artwork_url)
-
-    return embed
-
+class QueueEntry:
+    """
+    Compact representation of a queued track
 
-def track_embed(result: Track) -> discord.Embed:
-    if result.source == "twitch":
-        color = discord.Color.purple()
-    elif result.source == "youtube":
-        color = discord.Color.red()
-    elif result.source == "soundcloud":
-        color = discord.Color.orange()
-    else:
-        color = discord.Color.random()
+    Only the data needed to play the track, to account for its duration and to list it is kept,
+    the full mafic Track object is discarded once the track is added to the queue.
+    """
+    __slots__ = ("encoded", "length", "requester", "seq", "identifier", "title")
 
-    embed = discord.Embed(color=color)
+    def __init__(self, encoded: str, length: int, requester: int | None = None, seq: int = 0, identifier: str = "",
+                 title: str = ""):
+        self.encoded = encoded
+        self.length = length  # milliseconds
+        self.requester = requester
+        self.seq = seq  # insertion order, used to restore the order after a shuffle
+        self.identifier = identifier  # used to detect duplicates, empty for entries saved by older versions
+        self.title = title
 
-    embed.title = result.title
-    embed.url = result.uri
-    embed.set_author(name=result.author)
-    embed.set_thumbnail(url=result.artwork_url)
+    @classmethod
+    def from_track(cls, track: Track, requester: int | None = None, seq: int = 0) -> "QueueEntry":
+        return cls(track.id, track.length, requester, seq, track.identifier, track.title)
 
-    if not result.stream:
-        embed.add_field(name="Video duration", value=parse_seconds(result.length // 1000))
-    else:
-        embed.add_field(name="Live on", value=result.source)
-
-    return embed
-
-
-def parse_seconds(seconds: int) -> str:
-    minutes, seconds = divmod(seconds, 60)
-    hours, minutes = divmod(minutes, 60)
+    def to_track(self) -> Track:
+        """
+        Build a minimal mafic Track that can be sent to lavalink
+        :return: a Track object carrying only the encoded data and the length
+        """
+        return Track(
+            track_id=self.encoded,
+            identifier=self.identifier,
+            seekable=True,
+            author="",
+            length=self.length,
+            stream=False,
+            title=self.title,
+            uri=None,
+            artwork_url=None,
+            isrc=None,
+            source="",
+        )
+
+    def __repr__(self) -> str:
+        return f"<QueueEntry length={self.length} requester={self.requester} seq={self.seq}>"
 
-    result = "%(minutes)02d:%(seconds)02d" % {"minutes": minutes, "seconds": seconds}
 
-    if hours != 0:
-        result = f"{hours}:" + result
-    return result
+class Queue:
+    """
+    Per-player queue of tracks
+
+    The pending tracks are kept in a deque. When shuffle is enabled the deque holds a random permutation of
+    the pending tracks, so getting the next track is always a popleft. New tracks are placed in a random
+    position of the permutation (inside-out Fisher-Yates) and the original order is restored when shuffle
+    is disabled. Positions are in play order, so they are the positions of the permutation while shuffle is enabled.
+
+    An index counts the pending entries of each track identifier, so duplicates are detected without scanning the
+    queue. Removing or moving an entry by position runs in C on the deque, and a page of the queue is read with
+    indexed access that skips whole deque blocks.
+
+    Every change increments `version`, so a result computed from the queue (like a prefetched track) can be
+    checked for staleness.
+    """
+    __slots__ = ("_current", "_queue", "_queue_length", "_ids", "_loop_queue", "_loop_current", "_shuffle", "_seq",
+                 "_version", "limits")
+
+    def __init__(self, limits: QueueLimits | None = None):
+        self.limits = limits or QueueLimits()
+
+        self._current: QueueEntry | None = None
+        self._queue: deque[QueueEntry] = deque()
+        self._queue_length: int = 0  # milliseconds
+        # track identifier -> number of pending entries
+        self._ids: dict[str, int] = {}
+
+        self._loop_queue: bool = False
+        self._loop_current: bool = False
+        self._shuffle: bool = False
+
+        self._seq = count()
+        self._version = 0
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    @property
+    def current(self) -> QueueEntry | None:
+        return self._current
+
+    @property
+    def duration(self) -> int:
+        """Total duration of the pending tracks in milliseconds"""
+        return self._queue_length
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def loop(self) -> bool:
+        return self._loop_queue
 
+    @property
+    def repeat(self) -> bool:
+        return self._loop_current
 
-class Queue:
-    _current: Track | None = None
-    _queue: list[Track] = []
-    _queue_length: int = 0
+    @property
+    def shuffle(self) -> bool:
+        return self._shuffle
 
-    _loop_queue: bool = False
-    _loop_current: bool = False
-    _shuffle: bool = False
+    def has(self, identifier: str) -> bool:
+        """
+        Check if a track is playing or waiting in the queue
+        :param identifier: the track identifier
+        :return: True if the track is in the queue
+        """
+        if not identifier:
+            return False
+        current = self._current
+        return identifier in self._ids or (current is not None and current.identifier == identifier)
+
+    def _index(self, entry: QueueEntry):
+        if entry.identifier:
+            self._ids[entry.identifier] = self._ids.get(entry.identifier, 0) + 1
+
+    def _unindex(self, entry: QueueEntry):
+        count = self._ids.get(entry.identifier)
+        if count == 1:
+            del self._ids[entry.identifier]
+        elif count is not None:
+            self._ids[entry.identifier] = count - 1
 
     def toggle_loop(self, status: Optional[bool] = None) -> bool:
         """
@@ -81,11 +156,12 @@ class Queue:
         :param status: force a certain status on the loop queue
         :return: the current status
         """
-        if status:
+        if status is not None:
             self._loop_queue = status
         else:
             self._loop_queue = not self._loop_queue
 
+        self._version += 1
         return self._loop_queue
 
     def toggle_repeat(self, status: Optional[bool] = None) -> bool:
@@ -94,11 +170,12 @@ class Queue:
         :param status: force a certain status on the repeat value
         :return: the current status
         """
-        if status:
+        if status is not None:
             self._loop_current = status
         else:
             self._loop_current = not self._loop_current
 
+        self._version += 1
         return self._loop_current
 
     def toggle_shuffle(self, status: Optional[bool] = None) -> bool:
@@ -107,93 +184,224 @@ class Queue:
         :param status: force a certain status on the shuffle value
         :return: the current status
         """
-        if status:
-            self._shuffle = status
-        else:
-            self._shuffle = not self._shuffle
-
+        new_status = status if status is not None else not self._shuffle
+
+        if new_status and not self._shuffle:
+            entries = list(self._queue)
+            # the order may have been changed with move(), it is the one restored when shuffle is disabled
+            for entry, seq in zip(entries, self._seq):
+                entry.seq = seq
+            shuffle(entries)
+            self._queue = deque(entries)
+        elif not new_status and self._shuffle:
+            self._queue = deque(sorted(self._queue, key=lambda e: e.seq))
+
+        self._shuffle = new_status
+        self._version += 1
         return self._shuffle
 
-    def _add_to_queue(self, track: Track) -> int:
+    def _push(self, entry: QueueEntry):
+        """
+        Append an entry to the pending tracks, keeping the shuffle permutation uniform
+        :param entry: the entry to append
+        """
+        self._queue.append(entry)
+
+        if self._shuffle:
+            index = randrange(len(self._queue))
+            self._queue[index], self._queue[-1] = self._queue[-1], self._queue[index]
+
+    def _add_to_queue(self, track: Track, requester: int | None = None) -> int:
         """
         Add a track to the queue
         :param track: the track to add
+        :param requester: the id of the user that requested the track
         :return: if the track was added
         """
-        track_length = track.length // 1000
+        track_length = track.length
 
-        if track_length > 3600:  # max 1 hour
+        if track_length > self.limits.max_track_length:
             return -2
-        elif self._queue_length + track_length >= 8200:  # total max 132 minutes
+        elif self.has(track.identifier):
+            return -3
+        elif self._queue_length + track_length >= self.limits.max_total_length:
             return -1
-        elif len(self._queue) > 48:  # max 48 songs
+        elif len(self._queue) >= self.limits.max_tracks:
             return 0
         else:
+            entry = QueueEntry.from_track(track, requester, next(self._seq))
             self._queue_length += track_length
-            self._queue.append(track)
+            self._push(entry)
+            self._index(entry)
+            self._version += 1
             return 1
 
-    def add(self, data: Playlist | Track | list) -> discord.Embed | None:
+    def _add_many(self, tracks: list[Track], requester: int | None = None) -> tuple[int, int, int, int, int]:
+        """
+        Add a list of tracks to the queue, validating all of them in one pass
+        :param tracks: the tracks to add
+        :param requester: the id of the user that requested the tracks
+        :return: the number of tracks added and skipped because too long, already in the queue, over the total
+        duration and over the maximum number of tracks
+        """
+        limits = self.limits
+        eligible = [track for track in tracks if track.length <= limits.max_track_length]
+        too_long = len(tracks) - len(eligible)
+
+        # duplicates of the queue and of the playlist itself
+        ids = self._ids
+        seen = {self._current.identifier} if self._current is not None and self._current.identifier else set()
+        unique = []
+        for track in eligible:
+            identifier = track.identifier
+            if identifier in seen or identifier in ids:
+                continue
+            if identifier:
+                seen.add(identifier)
+            unique.append(track)
+        duplicates = len(eligible) - len(unique)
+        eligible = unique
+
+        # first index whose running total would reach the duration limit
+        budget = limits.max_total_length - self._queue_length
+        by_duration = bisect_left(list(accumulate(track.length for track in eligible)), budget)
+        by_count = max(limits.max_tracks - len(self._queue), 0)
+
+        accepted = eligible[:min(by_duration, by_count)]
+        if by_count < by_duration:
+            over_duration, over_count = 0, len(eligible) - len(accepted)
+        else:
+            over_duration, over_count = len(eligible) - len(accepted), 0
+
+        entries = [QueueEntry(t.id, t.length, requester, seq, t.identifier, t.title) for t, seq in zip(accepted, self._seq)]
+        if self._shuffle:
+            for entry in entries:
+                self._push(entry)
+        else:
+            self._queue.extend(entries)
+        # the accepted identifiers are distinct and not in the queue yet
+        self._ids.update((entry.identifier, 1) for entry in entries if entry.identifier)
+        self._queue_length += sum(entry.length for entry in entries)
+        self._version += 1
+
+        return len(entries), too_long, duplicates, over_duration, over_count
+
+    def add(self, data: Playlist | Track | list, requester: int | None = None) -> discord.Embed | None:
         """
         Add a playlist or a single track to the queue
 
         :param data: A playlist or a single track
+        :param requester: the id of the user that requested the tracks
         :return: an Embed for the added object or None if the object was not added
         """
         if isinstance(data, Track):
-            if self._add_to_queue(track=data) == 1:
+            if self._add_to_queue(track=data, requester=requester) == 1:
                 embed = track_embed(data)
             else:
                 return None
         elif isinstance(data, Playlist):
-            added = 0
-            for track in data.tracks:
-                ret = self._add_to_queue(track=track)
-                if ret == 1:
-                    added += 1
-                elif ret == 0:
-                    break
+            if len(data.tracks) == 0:
+                return None
+
+            added, too_long, duplicates, over_duration, over_count = self._add_many(data.tracks, requester=requester)
             embed = playlist_embed(data).add_field(name="Number of videos", value=added)
+
+            skipped = []
+            if too_long:
+                skipped.append(f"{too_long} too long")
+            if duplicates:
+                skipped.append(f"{duplicates} already in the queue")
+            if over_duration:
+                skipped.append(f"{over_duration} over the queue duration")
+            if over_count:
+                skipped.append(f"{over_count} over the queue size")
+            if skipped:
+                embed.add_field(name="Skipped", value=", ".join(skipped))
         elif isinstance(data, list):
             if len(data) == 0:
                 return None
-            return self.add(data[0])
+            return self.add(data[0], requester=requester)
         else:
             return None
 
         return embed
 
-    def next(self) -> Track | None:
+    def peek(self) -> QueueEntry | None:
+        """
+        Get the track that next() would return, without changing the queue
+        :return: a QueueEntry object
+        """
+        if self._loop_current and self._current is not None:
+            return self._current
+        return self._queue[0] if self._queue else None
+
+    def next(self) -> QueueEntry | None:
         """
         Get the next track to play
-        :return: a Track object
+        :return: a QueueEntry object
         """
-        if len(self._queue) == 0:
-            self._current = None
-            return None
+        self._version += 1
 
-        if self._loop_current:
+        if self._loop_current and self._current is not None:
             return self._current
 
-        if self._shuffle:
-            index = randint(0, len(self._queue)) % len(self._queue)
-        else:
-            index = 0
-
-        try:
-            track = self._queue.pop(index)
-        except IndexError:
-            logger.error(f"IndexError in Queue.next, queue length: {len(self._queue)}, index: {index}")
+        if len(self._queue) == 0:
             self._current = None
             return None
 
+        entry = self._queue.popleft()
+
         if self._loop_queue:
-            self._queue.append(track)
+            self._push(entry)
         else:
-            self._queue_length -= track.length
+            self._queue_length -= entry.length
+            self._unindex(entry)
+
+        self._current = entry
+        return entry
+
+    def to_dict(self) -> dict:
+        """
+        Serialize the queue state
+        :return: a JSON serializable dict
+        """
+        current = self._current
+        return {
+            "current": [current.encoded, current.length, current.requester, current.seq, current.identifier,
+                        current.title] if current else None,
+            "queue": [[e.encoded, e.length, e.requester, e.seq, e.identifier, e.title] for e in self._queue],
+            "loop": self._loop_queue,
+            "repeat": self._loop_current,
+            "shuffle": self._shuffle,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict, limits: QueueLimits | None = None) -> "Queue":
+        """
+        Rebuild a queue serialized with to_dict
+        :param data: the serialized state
+        :param limits: the limits of the new queue
+        :return: a Queue object
+        """
+        queue = cls(limits=limits)
+
+        queue._queue = deque(QueueEntry(*item) for item in data.get("queue", []))
+        queue._queue_length = sum(entry.length for entry in queue._queue)
+        for entry in queue._queue:
+            queue._index(entry)
+        if data.get("current"):
+            queue._current = QueueEntry(*data["current"])
 
-        self._current = track
-        return track
+        queue._loop_queue = bool(data.get("loop", False))
+        queue._loop_current = bool(data.get("repeat", False))
+        queue._shuffle = bool(data.get("shuffle", False))
+
+        seqs = [entry.seq for entry in queue._queue]
+        if queue._current is not None:
+            seqs.append(queue._current.seq)
+        queue._seq = count(max(seqs, default=-1) + 1)
+
+        return queue
 
     def clean(self) -> int:
         """
@@ -201,9 +409,69 @@ class Queue:
         :return: the number of elements removed
         """
         size = len(self._queue)
-        del self._queue
-        self._queue = []
+        self._queue.clear()
+        self._ids.clear()
         self._queue_length = 0
         self._current = None
+        self._version += 1
 
         return size
+
+    def discard(self, entry: QueueEntry) -> bool:
+        """
+        Remove a pending entry
+        :param entry: the entry to remove
+        :return: if the entry was in the queue
+        """
+        try:
+            self._queue.remove(entry)
+        except ValueError:
+            return False
+
+        self._queue_length -= entry.length
+        self._unindex(entry)
+        self._version += 1
+        return True
+
+    def entries(self, start: int, stop: int) -> list[QueueEntry]:
+        """
+        Get the pending entries between two positions
+        :param start: the first position, from 0
+        :param stop: the position after the last one
+        :return: the entries in play order
+        """
+        queue = self._queue
+        return [queue[i] for i in range(max(start, 0), min(stop, len(queue)))]
+
+    def remove(self, position: int) -> QueueEntry:
+        """
+        Remove a pending entry by position
+        :param position: the position in play order, from 0
+        :return: the removed entry
+        """
+        if not 0 <= position < len(self._queue):
+            raise IndexError("queue position out of range")
+
+        entry = self._queue[position]
+        del self._queue[position]
+        self._queue_length -= entry.length
+        self._unindex(entry)
+        self._version += 1
+        return entry
+
+    def move(self, source: int, destination: int) -> QueueEntry:
+        """
+        Move a pending entry to a different position
+        :param source: the position of the entry, from 0
+        :param destination: the new position of the entry, from 0
+        :return: the moved entry
+        """
+        size = len(self._queue)
+        if not (0 <= source < size and 0 <= destination < size):
+            raise IndexError("queue position out of range")
+
+        entry = self._queue[source]
+        del self._queue[source]
+        self._queue.insert(destination, entry)
+        self._version += 1
+        return entry
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+from typing import Callable, Hashable
+
+import discord
+
+from .player import LavalinkPlayer
+
+__all__ = [
+    "TimerWheel",
+    "IdleReaper"
+]
+
+
+logger = logging.getLogger('dsbot.music.reaper')
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel: one loop callback every `resolution` seconds serves all the timers
+
+    Each key has at most one timer, scheduling it again replaces the previous one. Delays are rounded up to the
+    resolution.
+    """
+
+    def __init__(self, resolution: float = 1.0, slots: int = 64):
+        self.resolution = resolution
+        self._slots: list[dict[Hashable, tuple[int, Callable[[], None]]]] = [{} for _ in range(slots)]
+        self._where: dict[Hashable, int] = {}
+        self._cursor = 0
+        self._handle: asyncio.TimerHandle | None = None
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._where
+
+    def start(self, loop: asyncio.AbstractEventLoop | None = None):
+        if self._handle is None:
+            loop = loop or asyncio.get_running_loop()
+            self._handle = loop.call_later(self.resolution, self._tick, loop)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def schedule(self, key: Hashable, delay: float, callback: Callable[[], None]):
+        """
+        Run a callback after a delay
+        :param key: identifies the timer
+        :param delay: seconds before the callback runs
+        :param callback: a function without arguments
+        """
+        self.cancel(key)
+
+        ticks = max(1, -int(-delay // self.resolution))
+        rounds, offset = divmod(ticks - 1, len(self._slots))
+        slot = (self._cursor + offset) % len(self._slots)
+
+        self._slots[slot][key] = (rounds, callback)
+        self._where[key] = slot
+
+    def cancel(self, key: Hashable) -> bool:
+        """
+        Cancel a timer
+        :param key: identifies the timer
+        :return: True if the timer was pending
+        """
+        slot = self._where.pop(key, None)
+        if slot is None:
+            return False
+        del self._slots[slot][key]
+        return True
+
+    def _tick(self, loop: asyncio.AbstractEventLoop):
+        self._handle = loop.call_later(self.resolution, self._tick, loop)
+
+        slot = self._slots[self._cursor]
+        self._cursor = (self._cursor + 1) % len(self._slots)
+
+        expired = []
+        for key, (rounds, callback) in slot.items():
+            if rounds == 0:
+                expired.append((key, callback))
+            else:
+                slot[key] = (rounds - 1, callback)
+
+        for key, callback in expired:
+            del slot[key]
+            del self._where[key]
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Error in timer {key!r}: {e}")
+
+
+class IdleReaper:
+    """
+    Disconnect the players nobody is listening to, freeing their lavalink player
+
+    A player is disconnected `grace` seconds after the last member left its channel, or `idle` seconds after it
+    stopped playing.
+    """
+
+    def __init__(self, bot: discord.Client, grace: float = 30, idle: float = 300, wheel: TimerWheel | None = None):
+        self.bot = bot
+        self.grace = grace
+        self.idle = idle
+        self.wheel = wheel or TimerWheel()
+        self._tasks: set[asyncio.Task] = set()
+
+    def start(self):
+        self.wheel.start()
+
+    def stop(self):
+        self.wheel.stop()
+
+    def forget(self, guild_id: int):
+        """Cancel the timers of a guild whose player is gone"""
+        self.wheel.cancel(("alone", guild_id))
+        self.wheel.cancel(("idle", guild_id))
+
+    @staticmethod
+    def _listeners(vc: LavalinkPlayer) -> int:
+        return sum(1 for member in vc.channel.members if not member.bot)
+
+    @staticmethod
+    def _idle(vc: LavalinkPlayer) -> bool:
+        return vc.current is None or vc.paused
+
+    def check_channel(self, vc: LavalinkPlayer):
+        """Start or cancel the grace period, after a member joined or left the player channel"""
+        key = ("alone", vc.guild.id)
+        if self._listeners(vc) == 0:
+            if key not in self.wheel:
+                self.wheel.schedule(key, self.grace, lambda: self._reap(vc.guild.id, "nobody listening"))
+        else:
+            self.wheel.cancel(key)
+
+    def check_idle(self, vc: LavalinkPlayer):
+        """Start the idle timer, when the player may have stopped playing"""
+        self.wheel.schedule(("idle", vc.guild.id), self.idle, lambda: self._reap(vc.guild.id, "idle", idle_only=True))
+
+    def playing(self, vc: LavalinkPlayer):
+        """Cancel the idle timer of a player that started a track"""
+        self.wheel.cancel(("idle", vc.guild.id))
+
+    def _reap(self, guild_id: int, reason: str, idle_only: bool = False):
+        guild = self.bot.get_guild(guild_id)
+        vc = guild.voice_client if guild is not None else None
+        if not isinstance(vc, LavalinkPlayer):
+            return
+
+        # the player could have started again since the timer was set
+        if idle_only and not self._idle(vc):
+            return
+        if not idle_only and self._listeners(vc) > 0:
+            return
+
+        self.forget(guild_id)
+        task = asyncio.create_task(self._disconnect(vc, reason))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    async def _disconnect(vc: LavalinkPlayer, reason: str):
+        logger.info(f"Disconnecting player {vc.guild.id}: {reason}")
+        vc.clean_queue()
+        try:
+            await vc.disconnect(force=True)
+        except Exception as e:
+            logger.error(f"Error disconnecting player {vc.guild.id}: {e}")
@@ -0,0 +1,166 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, TypeVar
+
+from ..metrics import metrics
+from .cache import URL_REGEX
+
+__all__ = [
+    "ResolveRejected",
+    "ResolveScheduler"
+]
+
+
+logger = logging.getLogger('dsbot.music.scheduler')
+
+T = TypeVar("T")
+
+# Lower values are served first: an URL resolves with a single lookup, a search costs a lot more to the node
+PRIORITY_URL = 0
+PRIORITY_SEARCH = 1
+PRIORITY_NAMES = ("url", "search")
+
+
+class ResolveRejected(Exception):
+    """The request was dropped by the scheduler before reaching lavalink"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "future")
+
+    def __init__(self, priority: int, seq: int, future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _NodeSlots:
+    __slots__ = ("active", "waiting")
+
+    def __init__(self):
+        self.active = 0
+        self.waiting: list[_Waiter] = []
+
+
+class ResolveScheduler:
+    """
+    Admission control for the lavalink track resolution
+
+    Each node runs at most `concurrency` requests at once, the others wait in a priority queue where URLs go before
+    searches. Every guild has a token bucket of `burst` requests refilled at `rate` per second, and every request
+    has a deadline: it is dropped if it does not get a slot in time, and cancelled if lavalink does not answer
+    before it, so a stale request never holds a node slot.
+    """
+
+    def __init__(self, concurrency: int = 4, max_waiting: int = 64, rate: float = 0.5, burst: int = 5):
+        self.concurrency = concurrency
+        self.max_waiting = max_waiting
+        self.rate = rate
+        self.burst = burst
+
+        self._nodes: dict[str, _NodeSlots] = {}
+        # guild id -> (tokens, last refill)
+        self._buckets: dict[int, tuple[float, float]] = {}
+        self._seq = itertools.count()
+
+    def stats(self) -> dict[str, tuple[int, int]]:
+        """
+        Get the number of running and waiting requests of each node
+        :return: a dict of node label -> (active, waiting)
+        """
+        return {label: (slots.active, len(slots.waiting)) for label, slots in self._nodes.items()}
+
+    def _take_token(self, guild_id: int) -> bool:
+        now = time.monotonic()
+        tokens, last = self._buckets.get(guild_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+        if tokens < 1:
+            self._buckets[guild_id] = (tokens, now)
+            return False
+
+        self._buckets[guild_id] = (tokens - 1, now)
+        return True
+
+    def _reject(self, reason: str):
+        metrics.resolve_rejections.inc(reason)
+        raise ResolveRejected(reason)
+
+    def _release(self, slots: _NodeSlots):
+        # Hand the slot over to the first waiter still interested in it
+        while slots.waiting:
+            waiter = heapq.heappop(slots.waiting)
+            if not waiter.future.done():
+                waiter.future.set_result(None)
+                return
+        slots.active -= 1
+
+    async def _acquire(self, slots: _NodeSlots, priority: int, deadline: float):
+        if slots.active < self.concurrency and not slots.waiting:
+            slots.active += 1
+            return
+
+        if len(slots.waiting) >= self.max_waiting:
+            self._reject("queue_full")
+
+        waiter = _Waiter(priority, next(self._seq), asyncio.get_running_loop().create_future())
+        heapq.heappush(slots.waiting, waiter)
+
+        try:
+            async with asyncio.timeout_at(deadline):
+                await waiter.future
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # the slot was handed over while the wait was interrupted
+                self._release(slots)
+            elif waiter in slots.waiting:
+                slots.waiting.remove(waiter)
+                heapq.heapify(slots.waiting)
+
+            if isinstance(e, asyncio.TimeoutError):
+                self._reject("deadline")
+            raise
+
+    async def submit(self, node: str, guild_id: int, query: str, fetch: Callable[[str], Awaitable[T]],
+                     timeout: float = 10) -> T:
+        """
+        Run a fetch_tracks call once the guild and the node allow it
+        :param node: the label of the node that will resolve the query
+        :param guild_id: the guild of the request
+        :param query: an URL or a search query
+        :param fetch: the coroutine function resolving the query
+        :param timeout: seconds before the request is dropped, including the time spent waiting
+        :return: the result of fetch
+        :raise ResolveRejected: when the guild is rate limited, the node queue is full or the deadline passed
+        :raise asyncio.TimeoutError: when lavalink does not answer before the deadline
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        deadline = start + timeout
+
+        if not self._take_token(guild_id):
+            self._reject("rate_limited")
+
+        priority = PRIORITY_URL if URL_REGEX.match(query.strip()) else PRIORITY_SEARCH
+        slots = self._nodes.get(node)
+        if slots is None:
+            slots = self._nodes[node] = _NodeSlots()
+
+        await self._acquire(slots, priority, deadline)
+        metrics.resolve_wait.observe(loop.time() - start, PRIORITY_NAMES[priority])
+
+        try:
+            async with asyncio.timeout_at(deadline):
+                return await fetch(query)
+        finally:
+            self._release(slots)
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+
+import discord
+
+from ..storage import JsonStore
+from .limits import get_limits
+from .player import LavalinkPlayer
+from .queue import Queue
+
+__all__ = [
+    "PlayerSnapshots"
+]
+
+
+logger = logging.getLogger('dsbot.music.snapshot')
+
+
+class PlayerSnapshots:
+    """
+    Save the state of every player and restore it after a restart
+
+    Tracks are stored as lavalink encoded strings, so restoring does not need to resolve any query again.
+    """
+
+    def __init__(self, bot: discord.Client, path: str = "data/players.json"):
+        self.bot = bot
+        self.store = JsonStore(path)
+        self.restored = False
+
+    def capture(self) -> dict[str, dict]:
+        """
+        Serialize the state of all the connected players
+        :return: a dict with the state of each guild player
+        """
+        data = {}
+
+        for vc in self.bot.voice_clients:
+            if not isinstance(vc, LavalinkPlayer) or not vc.connected:
+                continue
+
+            data[str(vc.guild.id)] = {
+                "channel": vc.channel.id,
+                "position": vc.position if vc.current is not None else 0,
+                "paused": vc.paused,
+                "playing": vc.current is not None,
+                "queue": vc.queue.to_dict(),
+            }
+
+        return data
+
+    def save(self):
+        """Schedule a write of the current state"""
+        # Until the old snapshot is restored, writing would overwrite it with an empty state
+        if self.restored:
+            self.store.save(self.capture())
+
+    async def flush(self):
+        """Write the current state now"""
+        self.save()
+        await self.store.flush()
+
+    async def restore(self) -> int:
+        """
+        Reconnect the players saved in the last snapshot and resume playback
+        :return: the number of players restored
+        """
+        if self.restored:
+            return 0
+
+        data = self.store.load(default={})
+        self.restored = True
+
+        results = await asyncio.gather(*(self._try_restore_player(k, v) for k, v in data.items()))
+        restored = sum(results)
+
+        if data:
+            logger.info(f"Restored {restored}/{len(data)} player(s)")
+        return restored
+
+    async def _try_restore_player(self, guild_id: str, state: dict) -> bool:
+        """A broken entry or player must not stop the other ones"""
+        try:
+            return await self._restore_player(int(guild_id), state)
+        except Exception as e:
+            logger.error(f"Could not restore the player of guild {guild_id}: {e}")
+            return False
+
+    async def _restore_player(self, guild_id: int, state: dict) -> bool:
+        guild = self.bot.get_guild(guild_id)
+        if guild is None or guild.voice_client is not None:
+            return False
+
+        channel = guild.get_channel(state["channel"])
+        if not isinstance(channel, (discord.VoiceChannel, discord.StageChannel)):
+            return False
+        if not any(not member.bot for member in channel.members):
+            return False
+
+        try:
+            vc: LavalinkPlayer = await channel.connect(self_deaf=True, cls=LavalinkPlayer, timeout=10)
+        except (discord.ClientException, asyncio.TimeoutError) as e:
+            logger.error(f"Could not reconnect to {channel.id} in guild {guild_id}: {e}")
+            return False
+
+        vc.queue = Queue.from_dict(state["queue"], limits=get_limits(guild_id))
+
+        current = vc.queue.current
+        if current is not None and state.get("playing") and await vc.wait_until_connected(timeout=6):
+            try:
+                await vc.play(current, start_time=state.get("position") or None, pause=state.get("paused"))
+            except Exception as e:
+                logger.error(f"Could not resume playback in guild {guild_id}: {e}")
+
+        return True
@@ -0,0 +1,44 @@
+import discord
+
+from .embeds import queue_embed, queue_pages
+from .player import LavalinkPlayer
+
+__all__ = [
+    "QueuePages"
+]
+
+
+class QueuePages(discord.ui.View):
+    """
+    Previous and next buttons under a page of the queue
+
+    Every click renders the requested page from the live queue, so the tracks shown are always the current ones.
+    """
+
+    def __init__(self, vc: LavalinkPlayer, page: int = 0, size: int = 10, timeout: float = 180):
+        super().__init__(timeout=timeout)
+        self.vc = vc
+        self.size = size
+        self.page = min(max(page, 0), queue_pages(vc.queue, size) - 1)
+        self._update_buttons()
+
+    def render(self) -> discord.Embed:
+        return queue_embed(self.vc.queue, self.page, self.size)
+
+    def _update_buttons(self):
+        self.previous.disabled = self.page == 0
+        self.next.disabled = self.page >= queue_pages(self.vc.queue, self.size) - 1
+
+    async def _show(self, interaction: discord.Interaction, page: int):
+        # the queue can have shrunk since the last render
+        self.page = min(max(page, 0), queue_pages(self.vc.queue, self.size) - 1)
+        self._update_buttons()
+        await interaction.response.edit_message(embed=self.render(), view=self)
+
+    @discord.ui.button(emoji="◀️", style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction: discord.Interaction, _: discord.ui.Button):
+        await self._show(interaction, self.page - 1)
+
+    @discord.ui.button(emoji="▶️", style=discord.ButtonStyle.secondary)
+    async def next(self, interaction: discord.Interaction, _: discord.ui.Button):
+        await self._show(interaction, self.page + 1)
@@ -0,0 +1,255 @@
+import logging
+from functools import reduce
+from operator import or_
+from typing import NamedTuple
+
+import mafic
+from mafic import Filter, Node, Track
+
+from .metrics import metrics
+
+__all__ = [
+    "NodeConfig",
+    "parse_node_config",
+    "load_strategy",
+    "node_load",
+    "migrate_player",
+    "PlayerState",
+    "ResumingNode"
+]
+
+logger = logging.getLogger('dsbot.lavalink')
+
+
+class NodeConfig(NamedTuple):
+    """A node of config/lavalink.json, a node whose address or password changes is a different node"""
+    uri: str
+    port: int
+    password: str
+
+
+def parse_node_config(data) -> list[NodeConfig]:
+    """
+    Validate the content of config/lavalink.json
+    :param data: the decoded json, a list of objects with uri, port and password
+    :return: the nodes, in the order of the file
+    """
+    if not isinstance(data, list):
+        raise ValueError("expected a list of nodes")
+
+    nodes = []
+    for index, item in enumerate(data):
+        if not isinstance(item, dict):
+            raise ValueError(f"node {index} is not an object")
+
+        uri, port, password = item.get("uri"), item.get("port"), item.get("password")
+        if not isinstance(uri, str) or not uri:
+            raise ValueError(f"node {index} has no uri")
+        if isinstance(port, bool) or not isinstance(port, int) or not 0 < port < 65536:
+            raise ValueError(f"node {index} has an invalid port")
+        if not isinstance(password, str):
+            raise ValueError(f"node {index} has no password")
+
+        if any((node.uri, node.port) == (uri, port) for node in nodes):
+            raise ValueError(f"node {uri}:{port} is listed twice")
+        nodes.append(NodeConfig(uri, port, password))
+
+    return nodes
+
+
+def node_load(node: Node) -> float:
+    """
+    Estimate the load of a node using the last stats sent by lavalink
+    :param node: the node to evaluate
+    :return: a score, lower is better
+    """
+    # stats are sent once a minute, the local player count keeps new players from piling on the same node
+    players = len(node.players)
+
+    stats = node.stats
+    if stats is None:
+        return 1_000_000 + players
+
+    players = max(players, stats.playing_player_count)
+    cpu = 100 * stats.cpu.lavalink_load
+    system = 50 * stats.cpu.system_load
+
+    frames = 0
+    if stats.frame_stats is not None:
+        # a playing player sends 3000 frames per minute
+        frames = (stats.frame_stats.deficit + stats.frame_stats.nulled) / 30
+
+    return players + cpu + system + frames
+
+
+def load_strategy(nodes: list[Node], _: int, __: int | None, ___: str | None) -> list[Node]:
+    """
+    Mafic strategy that selects the nodes with the lowest load
+    :param nodes: the available nodes
+    :return: the least loaded nodes
+    """
+    if len(nodes) <= 1:
+        return nodes
+
+    loads = [(node_load(node), node) for node in nodes]
+    lowest = min(load for load, _ in loads)
+
+    return [node for load, node in loads if load == lowest]
+
+
+class PlayerState:
+    """What lavalink needs to play a player again from where it was: track, position, pause, volume and filters"""
+    __slots__ = ("track", "position", "paused", "volume", "filter")
+
+    def __init__(self, track: Track | None, position: int, paused: bool, volume: int | None, filter: Filter | None):
+        self.track = track
+        self.position = position
+        self.paused = paused
+        self.volume = volume
+        self.filter = filter
+
+    @classmethod
+    def capture(cls, player: mafic.Player) -> "PlayerState":
+        """
+        Copy the state of a player
+        :param player: the player to copy
+        :return: a PlayerState object
+        """
+        # noinspection PyProtectedMember
+        filters = player._filters
+        return cls(
+            track=player.current,
+            position=player.position if player.current is not None else 0,
+            paused=player.paused,
+            # set by mafic after the first update sent to lavalink
+            volume=getattr(player, "_volume", None),
+            filter=reduce(or_, filters.values()) if filters else None,
+        )
+
+    async def replay(self, player: mafic.Player, node: Node):
+        """
+        Recreate a player on a node that does not have it, reusing the voice session
+        :param player: the player
+        :param node: the node
+        """
+        # noinspection PyProtectedMember
+        if player._session_id is None or player._server_state is None:
+            raise RuntimeError("Player has no voice session")
+
+        # noinspection PyProtectedMember
+        await node.voice_update(
+            guild_id=player.guild.id,
+            session_id=player._session_id,
+            data=player._server_state,
+            channel_id=int(player.channel.id),
+        )
+
+        # sent to the node directly, the player may not be reported as connected yet
+        if self.track is not None:
+            await node.update(guild_id=player.guild.id, track=self.track, position=self.position, pause=self.paused,
+                              volume=self.volume, filter=self.filter, no_replace=False)
+        elif self.volume is not None or self.filter is not None:
+            await node.update(guild_id=player.guild.id, volume=self.volume, filter=self.filter)
+
+
+async def migrate_player(player: mafic.Player, target: Node, state: PlayerState | None = None):
+    """
+    Move a player to a different node without contacting the old one, that may be offline
+    :param player: the player to move
+    :param target: the new node
+    :param state: the state to replay, by default the current one
+    """
+    # noinspection PyProtectedMember
+    old = player._node
+    if old is target:
+        return
+
+    # noinspection PyProtectedMember
+    if player._session_id is None or player._server_state is None:
+        raise RuntimeError("Player has no voice session")
+
+    state = state or PlayerState.capture(player)
+
+    if old is not None:
+        old.remove_player(player.guild.id)
+
+    player._node = target
+    target.add_player(player.guild.id, player)
+
+    await state.replay(player, target)
+
+    logger.info(f"Player {player.guild.id} moved to node {target.label}")
+
+
+class ResumingNode(Node):
+    """
+    Node that gets its lavalink session back after a reconnect
+
+    Lavalink keeps a session and its players playing for `resume_timeout` seconds after the websocket is lost. The
+    next connection presents the session id, so lavalink hands the session back as it is. If the session is gone
+    (lavalink restarted, or the timeout expired) the players are replayed on the new session from their saved state,
+    instead of being disconnected.
+    """
+
+    def __init__(self, *args, resume_timeout: int = 60, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.resume_timeout = resume_timeout
+        self.resumed = False
+
+        # guild id -> state of the players when the websocket was lost
+        self._saved: dict[int, PlayerState] = {}
+
+    def save_players(self):
+        """Save the state of the players, before the position drifts while the node is unreachable"""
+        self._saved = {player.guild.id: PlayerState.capture(player) for player in self.players}
+
+    def saved_state(self, guild_id: int) -> PlayerState | None:
+        """
+        Take the saved state of a player
+        :param guild_id: the player guild
+        :return: the state, None if it was not saved
+        """
+        return self._saved.pop(guild_id, None)
+
+    async def _handle_msg(self, data) -> None:
+        if data["op"] == "ready":
+            self.resumed = data["resumed"]
+            if self._saved or self.players:
+                metrics.session_resumes.inc(self.label, "resumed" if self.resumed else "lost")
+                logger.info(f"Node {self.label} {'resumed' if self.resumed else 'lost'} its session")
+            if self.resumed:
+                self._saved.clear()
+
+        await super()._handle_msg(data)
+
+    def configure_resuming(self):
+        if self.version == 3:
+            return super().configure_resuming()
+
+        # the next connection presents this session, so lavalink resumes it
+        self._resuming_session_id = self.session_id
+
+        # the REST helper is private to mafic, without it mafic sets its own 60 seconds timeout
+        request = getattr(self, "_Node__request", None)
+        if request is None:
+            logger.warning(f"Cannot set the resuming timeout of node {self.label} with this mafic version")
+            return super().configure_resuming()
+
+        return request("PATCH", f"sessions/{self.session_id}", {"resuming": True, "timeout": self.resume_timeout})
+
+    async def _remove_unknown_player(self, player_id: int) -> None:
+        # called by sync_players for the players lavalink does not have anymore
+        player = self.get_player(player_id)
+        state = self.saved_state(player_id)
+        if player is None:
+            return await super()._remove_unknown_player(player_id)
+
+        try:
+            await (state or PlayerState.capture(player)).replay(player, self)
+        except Exception as e:
+            logger.error(f"Failed to replay player {player_id} on node {self.label}: {e}")
+            metrics.player_replays.inc("failed")
+            return await super()._remove_unknown_player(player_id)
+
+        metrics.player_replays.inc("ok")
+        logger.info(f"Player {player_id} replayed on node {self.label}")
@@ -0,0 +1,175 @@
+import asyncio
+import contextlib
+import logging
+import os
+import tempfile
+from typing import Any, Iterable
+
+import orjson
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+__all__ = [
+    "JsonStore",
+    "write_atomic"
+]
+
+
+logger = logging.getLogger('dsbot.storage')
+
+
+def write_atomic(path: str, data: bytes):
+    """
+    Write a file atomically, replacing the old one only after the new one is on disk
+    :param path: the destination file
+    :param data: the content of the file
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates the file readable only by the owner
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    """
+    Hold an exclusive lock shared between processes, a no-op where fcntl is not available
+    :param path: the file to protect, the lock is taken on a sibling .lock file
+    """
+    if fcntl is None:
+        yield
+        return
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def merge_atomic(path: str, updates: bytes):
+    """
+    Update some top-level keys of a JSON object file, leaving the others as they are on disk
+    :param path: the destination file
+    :param updates: a JSON object with the new values, null values remove the key
+    """
+    with file_lock(path):
+        try:
+            with open(path, "rb") as f:
+                current = orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError):
+            current = {}
+
+        for key, value in orjson.loads(updates).items():
+            if value is None:
+                current.pop(key, None)
+            else:
+                current[key] = value
+
+        write_atomic(path, orjson.dumps(current))
+
+
+class JsonStore:
+    """
+    Write-behind JSON persistence
+
+    Changes are coalesced and written at most once every `delay` seconds. The object is serialized on the event
+    loop, while the file is written in the default executor.
+
+    When the file is shared between processes, each one saves only the top-level keys it changed and they are
+    merged into the file under a lock.
+    """
+
+    def __init__(self, path: str, delay: float = 1.0):
+        self.path = path
+        self.delay = delay
+
+        self._data: Any = None
+        self._dirty = False
+        # top-level keys changed since the last write, None to rewrite the whole file
+        self._keys: set[str] | None = None
+        self._handle: asyncio.TimerHandle | None = None
+        self._task: asyncio.Task | None = None
+
+    def load(self, default: Any = None) -> Any:
+        """
+        Read the file synchronously, meant to be used only at startup
+        :param default: the value returned if the file does not exist
+        :return: the decoded content
+        """
+        if os.path.exists(self.path) and os.path.isfile(self.path):
+            with open(self.path, "rb") as f:
+                try:
+                    return orjson.loads(f.read())
+                except orjson.JSONDecodeError as e:
+                    logger.error(f"Invalid data in {self.path}: {e}")
+        return default
+
+    def save(self, data: Any, keys: Iterable[str] | None = None):
+        """
+        Schedule a write of the object, returning immediately
+        :param data: the object to store, it is serialized when the write happens
+        :param keys: the top-level keys that changed, only these are merged into the file
+        """
+        if keys is None or (self._dirty and self._keys is None):
+            self._keys = None
+        else:
+            self._keys = (self._keys if self._dirty else set()) | set(keys)
+
+        self._data = data
+        self._dirty = True
+
+        if self._handle is None and (self._task is None or self._task.done()):
+            loop = asyncio.get_running_loop()
+            self._handle = loop.call_later(self.delay, self._start_write)
+
+    def _start_write(self):
+        self._handle = None
+        self._task = asyncio.create_task(self._write())
+
+    async def _write(self):
+        while self._dirty:
+            self._dirty = False
+            keys, self._keys = self._keys, None
+
+            if keys is None:
+                write, payload = write_atomic, orjson.dumps(self._data)
+            else:
+                write, payload = merge_atomic, orjson.dumps({key: self._data.get(key) or None for key in keys})
+
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, write, self.path, payload)
+            except OSError as e:
+                logger.error(f"Could not write {self.path}: {e}")
+
+    async def flush(self):
+        """Write the pending changes now"""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+        if self._task is not None and not self._task.done():
+            await self._task
+
+        if self._dirty:
+            self._task = asyncio.create_task(self._write())
+            await self._task
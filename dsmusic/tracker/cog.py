@@ -1,4 +1,3 @@
-import json
 import logging
 import os
 
@@ -7,44 +6,107 @@ from discord import app_commands
 from discord.app_commands import AppCommandChannel
 from discord.ext import commands
 
+from ..metrics import metrics
+from ..storage import JsonStore
+from .notifier import Notifier
+
 logger = logging.getLogger('dsbot.tracker.cog')
 
+# Raw presence updates were added in discord.py 2.5
+RAW_PRESENCES = hasattr(discord, "RawPresenceUpdateEvent")
+
+# Gateway intents used by the cog, members are not needed when uncached members are handled with raw presence updates
+INTENTS = discord.Intents(guilds=True, presences=True, members=not RAW_PRESENCES)
+
 
 @app_commands.guild_only()
 class Tracker(commands.Cog):
-    tracking: dict[str, dict[str, str]] = {}
+    tracking: dict[str, dict[str, str]]
 
-    def __init__(self, bot: discord.Client, data_file: str = "data/tracker.json"):
+    def __init__(self, bot: discord.Client, data_file: str = "data/tracker.json", debounce: float = 10):
         self.bot = bot
+        self.notifier = Notifier(bot, window=debounce)
+        self.store = JsonStore(data_file)
+        self.tracking = self.store.load(default={})
+
+        # (guild id, user id) -> channel id, rebuilt every time tracking changes
+        self._index: dict[tuple[int, int], int] = {}
+        self._rebuild_index()
 
-        if os.path.exists(data_file) and os.path.isfile(data_file):
-            with open(data_file) as f:
-                self.tracking = json.load(f)
+        # last status of the tracked members that are not in the member cache
+        self._status: dict[tuple[int, int], discord.Status] = {}
+
+    async def cog_unload(self):
+        self.notifier.close()
+        await self.store.flush()
+
+    def _rebuild_index(self):
+        """Build the int-keyed lookup table used to filter presence updates"""
+        self._index = {
+            (int(guild_id), int(user_id)): int(channel_id)
+            for guild_id, users in self.tracking.items()
+            for user_id, channel_id in users.items()
+        }
 
     @commands.Cog.listener("on_presence_update")
     async def on_member_update(self, before: discord.Member, after: discord.Member):
         """Check if a tracked user is online"""
-        if before.status != after.status and after.status == discord.Status.online:
-            if str(after.guild.id) in self.tracking:
-                if str(after.id) in self.tracking[str(after.guild.id)]:
-                    channel = self.bot.get_channel(int(self.tracking[str(after.guild.id)][str(after.id)]))
-                    if channel.guild == after.guild:
-                        await channel.send(f"{after.mention} is now {after.status}")
+        # Most of the presence updates are for untracked members, reject them with a single lookup
+        channel_id = self._index.get((after.guild.id, after.id))
+        if channel_id is None:
+            return
+
+        metrics.presence_updates.inc("tracked")
+        self._status_changed(after.guild, after.id, channel_id, before.status, after.status)
+
+    if RAW_PRESENCES:
+        @commands.Cog.listener("on_raw_presence_update")
+        async def on_raw_presence_update(self, payload: "discord.RawPresenceUpdateEvent"):
+            """Check if a tracked user is online, when the member is not cached"""
+            key = (payload.guild_id, payload.user_id)
+            channel_id = self._index.get(key)
+            if channel_id is None:
+                return
+
+            # Cached members are handled by on_presence_update
+            if payload.guild is None or payload.guild.get_member(payload.user_id) is not None:
+                return
+
+            metrics.presence_updates.inc("tracked")
+            status = payload.client_status.status
+            # Users that went offline before the bot started are never seen, treat them as offline
+            before = self._status.get(key, discord.Status.offline)
+            self._status[key] = status
+
+            self._status_changed(payload.guild, payload.user_id, channel_id, before, status)
+
+    def _status_changed(self, guild: discord.Guild, user_id: int, channel_id: int,
+                        before: discord.Status, after: discord.Status):
+        """Hand the transitions from and to online over to the notifier, that sends the messages"""
+        if before == after:
+            return
+
+        if after == discord.Status.online:
+            channel = self.bot.get_channel(channel_id)
+            if channel is not None and channel.guild == guild:
+                self.notifier.online(guild.id, user_id, channel_id)
+        elif before == discord.Status.online and self.notifier.cancel(guild.id, user_id):
+            metrics.presence_updates.inc("debounced")
 
     def add(self, user: discord.Member, channel: discord.TextChannel):
         self.tracking.setdefault(str(user.guild.id), {})
         self.tracking[str(user.guild.id)][str(user.id)] = str(channel.id)
-
-        with open("config/tracker.json", "w") as f:
-            json.dump(self.tracking, f)
+        self._rebuild_index()
+        self.store.save(self.tracking, keys=[str(user.guild.id)])
 
     def remove(self, user: discord.Member):
         if str(user.guild.id) in self.tracking:
             if str(user.id) in self.tracking[str(user.guild.id)]:
                 del self.tracking[str(user.guild.id)][str(user.id)]
-
-                with open("config/tracker.json", "w") as f:
-                    json.dump(self.tracking, f)
+                self._status.pop((user.guild.id, user.id), None)
+                self.notifier.cancel(user.guild.id, user.id)
+                self._rebuild_index()
+                self.store.save(self.tracking, keys=[str(user.guild.id)])
 
     @app_commands.command(name="track", description="Track a user status")
     @app_commands.describe(username="The user you want to track")
@@ -74,5 +136,5 @@ class Tracker(commands.Cog):
 
 async def setup(bot: commands.Bot) -> None:
     logger.debug("Loading tracker cog")
-    await bot.add_cog(Tracker(bot))
+    await bot.add_cog(Tracker(bot, debounce=float(os.getenv("TRACKER_DEBOUNCE", "10"))))
     logger.info("Tracker cog loaded")
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+
+import discord
+
+from ..metrics import metrics
+
+__all__ = [
+    "Notifier"
+]
+
+
+logger = logging.getLogger('dsbot.tracker.notifier')
+
+# A message with more mentions is split, it keeps the content well below the 2000 characters limit
+MAX_MENTIONS = 50
+
+
+class Notifier:
+    """
+    Outbound queue of the tracker notifications
+
+    A user going online is notified only if still online after `window` seconds, so flapping statuses produce a
+    single message. Users ready in the same channel are sent together, and every channel is drained by its own task
+    sending at most one message every `interval` seconds: presence handlers never wait on the discord API.
+    """
+
+    def __init__(self, bot: discord.Client, window: float = 10, interval: float = 1.5):
+        self.bot = bot
+        self.window = window
+        self.interval = interval
+
+        # (guild id, user id) -> (channel id, timer) for the users waiting for the debounce window
+        self._pending: dict[tuple[int, int], tuple[int, asyncio.TimerHandle]] = {}
+        # channel id -> user ids to notify, in order
+        self._queues: dict[int, dict[int, None]] = {}
+        self._senders: dict[int, asyncio.Task] = {}
+        # channel id -> time before which no message is sent
+        self._next_send: dict[int, float] = {}
+
+    def online(self, guild_id: int, user_id: int, channel_id: int):
+        """
+        Schedule the notification of a user that went online
+        :param guild_id: the guild of the user
+        :param user_id: the user id
+        :param channel_id: the channel where the notification is sent
+        """
+        key = (guild_id, user_id)
+        if key in self._pending:
+            return
+
+        handle = asyncio.get_running_loop().call_later(self.window, self._ready, key)
+        self._pending[key] = (channel_id, handle)
+
+    def cancel(self, guild_id: int, user_id: int) -> bool:
+        """
+        Drop the pending notification of a user that is not online anymore
+        :param guild_id: the guild of the user
+        :param user_id: the user id
+        :return: True if a notification was pending
+        """
+        pending = self._pending.pop((guild_id, user_id), None)
+        if pending is None:
+            return False
+
+        pending[1].cancel()
+        return True
+
+    def close(self):
+        """Drop all the pending notifications and stop the senders"""
+        for _, handle in self._pending.values():
+            handle.cancel()
+        self._pending.clear()
+
+        for task in self._senders.values():
+            task.cancel()
+        self._senders.clear()
+        self._queues.clear()
+
+    def _ready(self, key: tuple[int, int]):
+        channel_id, _ = self._pending.pop(key)
+        self._queues.setdefault(channel_id, {})[key[1]] = None
+
+        sender = self._senders.get(channel_id)
+        if sender is None or sender.done():
+            self._senders[channel_id] = asyncio.create_task(self._drain(channel_id))
+
+    async def _drain(self, channel_id: int):
+        try:
+            while self._queues.get(channel_id):
+                delay = self._next_send.get(channel_id, 0) - time.monotonic()
+                if delay > 0:
+                    # more users can be queued meanwhile, they are sent in the same message
+                    await asyncio.sleep(delay)
+
+                users = list(self._queues[channel_id])[:MAX_MENTIONS]
+                for user_id in users:
+                    del self._queues[channel_id][user_id]
+
+                await self._send(channel_id, users)
+                self._next_send[channel_id] = time.monotonic() + self.interval
+        finally:
+            if not self._queues.get(channel_id):
+                self._queues.pop(channel_id, None)
+            if self._senders.get(channel_id) is asyncio.current_task():
+                del self._senders[channel_id]
+
+    async def _send(self, channel_id: int, users: list[int]):
+        channel = self.bot.get_channel(channel_id)
+        if channel is None:
+            self._queues.pop(channel_id, None)
+            return
+
+        mentions = ", ".join(f"<@{user_id}>" for user_id in users)
+        content = f"{mentions} {'is' if len(users) == 1 else 'are'} now {discord.Status.online}"
+
+        try:
+            await channel.send(content)
+        except discord.Forbidden:
+            logger.warning(f"Missing permissions to notify in channel {channel_id}")
+            self._queues.pop(channel_id, None)
+            return
+        except discord.HTTPException as e:
+            logger.error(f"Could not notify in channel {channel_id}: {e}")
+            return
+
+        metrics.presence_updates.inc("notified", amount=len(users))